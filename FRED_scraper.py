@@ -1,15 +1,267 @@
 import os
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
+from functions import get_cache_dir, get_engine, get_logger
 
 load_dotenv()
 
-def collect_metrics() -> dict:
+mylogger = get_logger()
+
+# Compute the metrics with aggregate queries on the DB server, instead of loading the tables into pandas.
+# Set FRED_SQL_PUSHDOWN=false to use the pandas path.
+USE_SQL_PUSHDOWN = os.getenv("FRED_SQL_PUSHDOWN", "true").lower() != "false"
+
+# Reuse the last computed metrics while none of the source tables changed. Set FRED_METRICS_CACHE=false to disable.
+USE_SNAPSHOT_CACHE = os.getenv("FRED_METRICS_CACHE", "true").lower() != "false"
+# Part of the snapshot key, next to the metric names and the SQL/pandas choice.
+# Bump it when a metric's definition changes without its name changing.
+SNAPSHOT_VERSION = 1
+SOURCE_TABLES = ("master_uw_translation_projects", "kr1_progress_data", "positive_pr")
+
+SCRIPTURE_STATUSES = ("Active", "Inactive", "Completed")
+
+# Columns of master_uw_translation_projects used by the pandas path, and which of those are low-cardinality
+MASTER_COLUMNS = [
+    "resource_package", "project_status", "scriptural_association", "bible_book_ref", "language_engagement_id",
+    "english_short_name", "resource_format", "primary_anglicized_name", "subtag_new", "scripture_text_name",
+    "translation_type",
+]
+MASTER_CATEGORICAL_COLUMNS = (
+    "resource_package", "project_status", "scriptural_association", "bible_book_ref", "resource_format",
+    "translation_type",
+)
+LOAD_CHUNKSIZE = 10_000
+
+def _exact(col: str) -> str:
+    # Compare/deduplicate on the exact bytes, like pandas does (MariaDB collations ignore case and trailing spaces)
+    return f"CAST({col} AS BINARY)"
+
+def _compute_metrics_sql(engine) -> dict:
+    """
+    Computes the same metrics as _compute_metrics_pandas, with aggregate queries on the server.
+    Only scalars are transferred.
+    """
+    statuses = ", ".join(f"'{status}'" for status in SCRIPTURE_STATUSES)
+    scripture_filter = (
+        f"{_exact('resource_package')} = 'Scripture Text' AND {_exact('project_status')} IN ({statuses})"
+    )
+    whole_bible = f"{_exact('scriptural_association')} IN ('Bible', 'OT', 'NT')"
+
+    with engine.connect() as conn:
+        # --- Completed OBS (distinct products) ---
+        obs_cols = ["language_engagement_id", "english_short_name", "bible_book_ref", "project_status",
+                    "resource_format"]
+        distinct_completed_OBS_count = conn.execute(text(f"""
+            SELECT COUNT(*) FROM (
+                SELECT DISTINCT {", ".join(f"{_exact(col)} AS {col}" for col in obs_cols)}
+                FROM master_uw_translation_projects
+                WHERE {_exact('resource_package')} = 'OBS' AND {_exact('project_status')} = 'Completed'
+            ) AS completed_obs
+        """)).scalar()
+
+        # --- Scripture Text "book" vs whole Bible/OT/NT counts (weighted 66/39/27), unique language engagements ---
+        book_count, bible_count, unique_language_engagement_ids = conn.execute(text(f"""
+            SELECT
+                COALESCE(SUM(CASE WHEN scriptural_association IS NULL OR NOT {whole_bible} THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE {_exact('scriptural_association')}
+                    WHEN 'Bible' THEN 66 WHEN 'OT' THEN 39 WHEN 'NT' THEN 27 ELSE 0 END), 0),
+                COUNT(DISTINCT {_exact('language_engagement_id')})
+            FROM master_uw_translation_projects
+            WHERE {scripture_filter}
+        """)).fetchone()
+
+        # --- Rolled-up counts over the distinct Scripture Text products ---
+        rolled_up_cols = ["language_engagement_id", "primary_anglicized_name", "subtag_new", "scripture_text_name",
+                          "resource_format", "translation_type", "project_status", "bible_book_ref"]
+        bible_count_rolled, ot_count_rolled, nt_count_rolled = conn.execute(text(f"""
+            SELECT
+                COALESCE(SUM(bible_book_ref = 'BIBLE'), 0),
+                COALESCE(SUM(bible_book_ref = 'OT'), 0),
+                COALESCE(SUM(bible_book_ref = 'NT'), 0)
+            FROM (
+                SELECT DISTINCT {", ".join(f"{_exact(col)} AS {col}" for col in rolled_up_cols)}
+                FROM master_uw_translation_projects
+                WHERE {scripture_filter}
+            ) AS rolled_up
+        """)).fetchone()
+
+        # Openly licensed resources from Aquifer
+        open_resources_aquifer = conn.execute(text("SELECT COUNT(resource_name) FROM kr1_progress_data")).scalar()
+
+    return {
+        "open_resources_aquifer": int(open_resources_aquifer),
+        "distinct_completed_OBS_count": int(distinct_completed_OBS_count),
+        "total_translated_product": int(bible_count) + int(book_count),
+        "bible_count_rolled": int(bible_count_rolled),
+        "nt_count_rolled": int(nt_count_rolled),
+        "ot_count_rolled": int(ot_count_rolled),
+        "unique_les_w_products": int(unique_language_engagement_ids),
+    }
+
+def _load_columns(engine, table: str, columns: list, categorical_columns: tuple = (),
+                  chunksize: int = LOAD_CHUNKSIZE) -> pd.DataFrame:
+    """
+    Streams the given columns of a table into a DataFrame, chunk by chunk.
+    Low-cardinality string columns are stored as categoricals as soon as each chunk arrives.
+    """
+    chunks = []
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(text(f"SELECT {', '.join(columns)} FROM {table}"), conn, chunksize=chunksize):
+            for col in categorical_columns:
+                # Give every chunk object categories: with pandas 3 an all-NULL chunk gets object
+                # categories and the others str, which union_categoricals below rejects
+                categorical = chunk[col].astype("category")
+                chunk[col] = categorical.cat.set_categories(categorical.cat.categories.astype(object))
+            chunks.append(chunk)
+
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+
+    # Concatenating categoricals with different categories would fall back to object, so union them
+    return pd.DataFrame({
+        col: (union_categoricals([chunk[col] for chunk in chunks]) if col in categorical_columns
+              else pd.concat([chunk[col] for chunk in chunks], ignore_index=True))
+        for col in columns
+    })
+
+# ========= PANDAS METRICS ENGINE =========
+# Boolean masks over master that several metrics share. Each one is evaluated once per run.
+MASTER_MASKS: Dict[str, Callable[[pd.DataFrame], pd.Series]] = {
+    "obs": lambda m: m["resource_package"] == "OBS",
+    "completed": lambda m: m["project_status"] == "Completed",
+    "scripture_text": lambda m: m["resource_package"] == "Scripture Text",
+    "scripture_status": lambda m: m["project_status"].isin(SCRIPTURE_STATUSES),
+}
+
+OBS_PRODUCT_COLUMNS = ("language_engagement_id", "english_short_name", "bible_book_ref", "project_status",
+                       "resource_format")
+ROLLED_UP_COLUMNS = ("language_engagement_id", "primary_anglicized_name", "subtag_new", "scripture_text_name",
+                     "resource_format", "translation_type", "project_status", "bible_book_ref")
+
+@dataclass
+class MasterMetric:
+    """
+    A KPI over master_uw_translation_projects: the rows matching all `masks`, narrowed to `columns`
+    (and deduplicated when `distinct` is set), reduced to a number by `aggregate`.
+    Metrics that share masks/columns/distinct share the same view.
+    """
+    name: str
+    masks: Tuple[str, ...]
+    columns: Tuple[str, ...]
+    aggregate: Callable[[pd.DataFrame], Any]
+    distinct: bool = False
+
+def _weighted_book_count(view: pd.DataFrame) -> int:
+    # Whole Bible/OT/NT products count as 66/39/27 books, everything else as one book
+    association = view["scriptural_association"]
+    conditions = [association == "Bible", association == "OT", association == "NT"]
+    return int(np.select(conditions, [66, 39, 27], default=1).sum())
+
+def _count_value(col: str, value: str) -> Callable[[pd.DataFrame], int]:
+    return lambda view: int((view[col] == value).sum())
+
+# Register new KPIs here
+MASTER_METRICS: List[MasterMetric] = [
+    MasterMetric("distinct_completed_OBS_count", ("obs", "completed"), OBS_PRODUCT_COLUMNS, len, distinct=True),
+    MasterMetric("total_translated_product", ("scripture_text", "scripture_status"), ("scriptural_association",),
+                 _weighted_book_count),
+    MasterMetric("bible_count_rolled", ("scripture_text", "scripture_status"), ROLLED_UP_COLUMNS,
+                 _count_value("bible_book_ref", "BIBLE"), distinct=True),
+    MasterMetric("nt_count_rolled", ("scripture_text", "scripture_status"), ROLLED_UP_COLUMNS,
+                 _count_value("bible_book_ref", "NT"), distinct=True),
+    MasterMetric("ot_count_rolled", ("scripture_text", "scripture_status"), ROLLED_UP_COLUMNS,
+                 _count_value("bible_book_ref", "OT"), distinct=True),
+    MasterMetric("unique_les_w_products", ("scripture_text", "scripture_status"), ROLLED_UP_COLUMNS,
+                 lambda view: int(view["language_engagement_id"].nunique()), distinct=True),
+]
+
+def compute_master_metrics(master: pd.DataFrame, metrics: List[MasterMetric] = MASTER_METRICS) -> Dict[str, Any]:
+    """
+    Evaluates every registered metric over master, computing each mask and each view only once.
+    """
+    masks: Dict[str, np.ndarray] = {}
+    views: Dict[Tuple, pd.DataFrame] = {}
+
+    def combined_mask(names: Tuple[str, ...]) -> np.ndarray:
+        result = np.ones(len(master), dtype=bool)
+        for mask_name in names:
+            if mask_name not in masks:
+                masks[mask_name] = MASTER_MASKS[mask_name](master).to_numpy(dtype=bool)
+            result &= masks[mask_name]
+        return result
+
+    results: Dict[str, Any] = {}
+    for metric in metrics:
+        view_key = (metric.masks, metric.columns, metric.distinct)
+        if view_key not in views:
+            view = master.loc[combined_mask(metric.masks), list(metric.columns)]
+            views[view_key] = view.drop_duplicates() if metric.distinct else view
+        results[metric.name] = metric.aggregate(views[view_key])
+    return results
+
+def _compute_metrics_pandas(engine) -> dict:
+    """Computes the master/kr1 metrics by loading both tables into pandas."""
+    # --- Load only the columns the metrics use ---
+    master = _load_columns(engine, "master_uw_translation_projects", MASTER_COLUMNS, MASTER_CATEGORICAL_COLUMNS)
+    kr1 = _load_columns(engine, "kr1_progress_data", ["resource_name"])
+
+    # Openly licensed resources from Aquifer
+    open_resources_aquifer = int(kr1["resource_name"].notna().sum())
+
+    return {
+        "open_resources_aquifer": open_resources_aquifer,
+        **compute_master_metrics(master),
+    }
+
+def _source_fingerprint(engine) -> Optional[Dict[str, Any]]:
+    """
+    Cheap fingerprint of the source tables: one CHECKSUM TABLE statement, computed on the server.
+    Returns None if any table can't be fingerprinted.
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"CHECKSUM TABLE {', '.join(SOURCE_TABLES)}")).fetchall()
+    fingerprint = {str(table).split(".")[-1]: checksum for table, checksum in rows}
+    if any(fingerprint.get(table) is None for table in SOURCE_TABLES):
+        return None
+    return fingerprint
+
+def _definition_key(use_sql: bool) -> Dict[str, Any]:
+    """What the metrics are computed with, so a snapshot of other definitions isn't reused."""
+    return {"version": SNAPSHOT_VERSION, "use_sql": use_sql, "metrics": sorted(m.name for m in MASTER_METRICS)}
+
+def _load_snapshot() -> Optional[Dict[str, Any]]:
+    snapshot_file = os.path.join(get_cache_dir("fred"), "metrics_snapshot.json")
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        mylogger.warning(f"Ignoring unreadable FRED metrics snapshot: {e}")
+        return None
+
+def _save_snapshot(fingerprint: Dict[str, Any], metrics: Dict[str, Any]) -> None:
+    # The metrics are already computed, so a cache that can't be written only costs the next run
+    try:
+        snapshot_file = os.path.join(get_cache_dir("fred"), "metrics_snapshot.json")
+        with open(snapshot_file, "w") as f:
+            json.dump({"fingerprint": fingerprint, "metrics": metrics}, f)
+    except OSError as e:
+        mylogger.warning(f"Could not write FRED metrics snapshot: {e}")
+
+def collect_metrics(use_sql: bool = USE_SQL_PUSHDOWN, use_cache: bool = USE_SNAPSHOT_CACHE) -> dict:
     """
     Computes and returns FRED summary metrics as a dict for the orchestrator.
+    When use_cache is set and neither the source tables nor the metric definitions changed
+    since the last run, the metrics of that run are returned without recomputing them.
     Keys:
       - total_pr
       - open_resources_aquifer
@@ -21,100 +273,28 @@ def collect_metrics() -> dict:
       - unique_language_engagement_ids
     """
 
-    # Build DB URI (matches your script’s connector settings)
-    db_user = os.getenv("TDB_USER")
-    db_password = os.getenv("TDB_PASSWORD")
-    db_name = os.getenv("TDB_DB")
-    db_host = os.getenv("TDB_HOST")
-#    db_uri = f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_host}/{db_name}"
-    db_uri = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}?charset=utf8mb4"
-
-    engine = None
     try:
-        engine = create_engine(db_uri, pool_pre_ping=True, pool_recycle=3600)
+        # Borrow a connection from the shared engine
+        engine = get_engine()
 
-        # --- Load the tables you use in your script ---
-        master = pd.read_sql("SELECT * FROM master_uw_translation_projects;", engine)
-        kr1 = pd.read_sql("SELECT * FROM kr1_progress_data;", engine)
+        fingerprint = _source_fingerprint(engine) if use_cache else None
+        if fingerprint is not None:
+            fingerprint = {"sources": fingerprint, "definition": _definition_key(use_sql)}
+            snapshot = _load_snapshot()
+            if snapshot is not None and snapshot["fingerprint"] == fingerprint:
+                mylogger.info("FRED source tables and metric definitions unchanged since the last run, reusing its metrics.")
+                return snapshot["metrics"]
 
         # COUNT(*) as scalar
         total_pr = int(pd.read_sql("SELECT COUNT(*) AS c FROM positive_pr;", engine)["c"].iloc[0])
 
-        # --- Completed OBS (distinct products) ---
-        OBS_only = master[master['resource_package'] == "OBS"]
-        completed_OBS = OBS_only[OBS_only['project_status'] == "Completed"]
-        distinct_completed_OBS_count = completed_OBS[[
-            'language_engagement_id',
-            'english_short_name',
-            'bible_book_ref',
-            'project_status',
-            'resource_format'
-        ]].drop_duplicates().shape[0]
-
-        # --- Scripture Text “book” vs rolled-up Bible/OT/NT counts ---
-        BT_growth = master[master['resource_package'] == "Scripture Text"]
-        books_view = BT_growth[
-            (~BT_growth['scriptural_association'].isin(['Bible', 'OT', 'NT'])) &
-            (BT_growth['project_status'].isin(['Active', 'Inactive', 'Completed']))
-        ]
-        book_count = int(len(books_view))
-
-        bible_view = BT_growth[
-            (BT_growth['scriptural_association'].isin(['Bible', 'OT', 'NT'])) &
-            (BT_growth['project_status'].isin(['Active', 'Inactive', 'Completed']))
-        ].sort_values(by='primary_anglicized_name').copy()
-
-        conditions = [
-            bible_view['scriptural_association'] == 'Bible',
-            bible_view['scriptural_association'] == 'OT',
-            bible_view['scriptural_association'] == 'NT'
-        ]
-        choices = [66, 39, 27]
-        bible_view['num_books'] = np.select(conditions, choices, default=1)
-
-        bible_count = int(bible_view['num_books'].sum())
-        total_product_count = int(bible_count + book_count)
-
-        # Rolled-up counts + unique language engagements
-        rolled_up = master[
-            (master['resource_package'] == "Scripture Text") &
-            (master['project_status'].isin(["Active", "Inactive", "Completed"]))
-        ][[
-            'language_engagement_id',
-            'primary_anglicized_name',
-            'subtag_new',
-            'scripture_text_name',
-            'resource_format',
-            'translation_type',
-            'project_status',
-            'bible_book_ref'
-        ]].drop_duplicates()
-
-        rolled_up_counts = rolled_up.groupby('bible_book_ref').size().reset_index(name='Counts')
-        book_counts_dict = rolled_up_counts.set_index('bible_book_ref')['Counts'].to_dict()
-
-        bible_count_rolled = int(book_counts_dict.get('BIBLE', 0))
-        ot_count_rolled = int(book_counts_dict.get('OT', 0))
-        nt_count_rolled = int(book_counts_dict.get('NT', 0))
-        unique_language_engagement_ids = int(rolled_up['language_engagement_id'].nunique())
+        metrics = _compute_metrics_sql(engine) if use_sql else _compute_metrics_pandas(engine)
+        metrics = {"total_pr_count": total_pr, **metrics}
 
-        # Openly licensed resources from Aquifer
-        no_na_kr1 = kr1[kr1['resource_name'].notna()]
-        open_resources_aquifer = int(len(no_na_kr1))
-
-        return {
-            "total_pr_count": total_pr,
-            "open_resources_aquifer": open_resources_aquifer,
-            "distinct_completed_OBS_count": distinct_completed_OBS_count,
-            "total_translated_product": total_product_count,
-            "bible_count_rolled": bible_count_rolled,
-            "nt_count_rolled": nt_count_rolled,
-            "ot_count_rolled": ot_count_rolled,
-            "unique_les_w_products": unique_language_engagement_ids,
-        }
+        if fingerprint is not None:
+            _save_snapshot(fingerprint, metrics)
+
+        return metrics
 
     except SQLAlchemyError as e:
         return {"status": "error", "error_message": str(e)}
-    finally:
-        if engine:
-            engine.dispose()
@@ -1,6 +1,13 @@
 # Contains all shared functions
+import atexit
 import logging
 import os
+import threading
+from time import perf_counter
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL
+from sqlalchemy.pool import QueuePool
 
 def get_logger():
   this_logger = logging.getLogger()
@@ -20,4 +27,131 @@ def get_logger():
 
     this_logger.addHandler(c_handler)
 
-  return this_logger
\ No newline at end of file
+  return this_logger
+
+def get_cache_dir(*sub_dirs):
+  """
+  Returns (and creates) the local cache directory, optionally a sub directory of it.
+  The location can be set with the CACHE_DIR env variable.
+  """
+  base_dir = os.getenv('CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+  cache_dir = os.path.join(base_dir, *sub_dirs)
+  os.makedirs(cache_dir, exist_ok=True)
+
+  return cache_dir
+
+
+#########################################################################################################
+#                       Process-wide DB engine, shared by all scripts
+#########################################################################################################
+_engine = None
+_engine_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_pool_stats = {
+  'connects': 0,
+  'connect_time': 0.0,
+  'checkouts': 0,
+  'checkout_time': 0.0,
+}
+
+
+def _add_pool_stats(counter, timer, elapsed):
+  with _stats_lock:
+    _pool_stats[counter] += 1
+    _pool_stats[timer] += elapsed
+
+
+class _InstrumentedQueuePool(QueuePool):
+  # QueuePool that records how long every checkout waited (including any new connect)
+  def _do_get(self):
+    start = perf_counter()
+    try:
+      return super()._do_get()
+    finally:
+      _add_pool_stats('checkouts', 'checkout_time', perf_counter() - start)
+
+
+def _get_ssl_ca():
+  # RDS CA bundle, as downloaded by the Dockerfile. Set TDB_SSL_CA to an empty value to disable.
+  default_ca = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aws-ssl-certs', 'us-west-2-bundle.pem')
+  ssl_ca = os.getenv('TDB_SSL_CA', default_ca)
+  if ssl_ca and os.path.exists(ssl_ca):
+    return ssl_ca
+
+  return None
+
+
+def _create_engine():
+  url = URL.create(
+    drivername='mysql+pymysql',
+    username=os.getenv('TDB_USER'),
+    password=os.getenv('TDB_PASSWORD'),
+    host=os.getenv('TDB_HOST'),
+    port=int(os.getenv('TDB_PORT', 3306)),
+    database=os.getenv('TDB_DB'),
+    query={'charset': 'utf8mb4'},
+  )
+
+  connect_args = {}
+  ssl_ca = _get_ssl_ca()
+  if ssl_ca:
+    connect_args['ssl'] = {'ca': ssl_ca}
+
+  engine = create_engine(
+    url,
+    poolclass=_InstrumentedQueuePool,
+    pool_size=int(os.getenv('TDB_POOL_SIZE', 5)),
+    max_overflow=int(os.getenv('TDB_POOL_MAX_OVERFLOW', 10)),
+    pool_timeout=int(os.getenv('TDB_POOL_TIMEOUT', 30)),
+    pool_recycle=int(os.getenv('TDB_POOL_RECYCLE', 3600)),
+    pool_pre_ping=True,
+    connect_args=connect_args,
+  )
+
+  @event.listens_for(engine, 'do_connect')
+  def _timed_connect(dialect, conn_rec, cargs, cparams):
+    start = perf_counter()
+    connection = dialect.connect(*cargs, **cparams)
+    _add_pool_stats('connects', 'connect_time', perf_counter() - start)
+    return connection
+
+  get_logger().debug(f"DB engine for host '{url.host}' created (ssl: {'on' if ssl_ca else 'off'}).")
+
+  return engine
+
+
+def get_engine():
+  """
+  Returns the process-wide SQLAlchemy engine for the tracking DB.
+  All scripts borrow their connections from its pool, so a run only pays for a handful of (TLS) connects.
+  Pool settings can be tuned with the TDB_POOL_* env variables.
+  """
+  global _engine
+
+  with _engine_lock:
+    if _engine is None:
+      _engine = _create_engine()
+      atexit.register(dispose_engine)
+
+  return _engine
+
+
+def get_pool_stats():
+  """Returns the connection pool statistics of this process: connects, checkouts and the time spent on them."""
+  with _stats_lock:
+    return dict(_pool_stats)
+
+
+def dispose_engine():
+  global _engine
+
+  with _engine_lock:
+    if _engine is None:
+      return
+    stats = get_pool_stats()
+    get_logger().info(
+      f"DB pool stats: {stats['connects']} connects ({stats['connect_time']:.3f}s), "
+      f"{stats['checkouts']} checkouts ({stats['checkout_time']:.3f}s waiting)"
+    )
+    _engine.dispose()
+    _engine = None
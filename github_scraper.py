@@ -1,8 +1,14 @@
 import requests
 import pandas as pd
 import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from urllib.parse import parse_qs, urlparse
 from dotenv import load_dotenv # Import load_dotenv
-from functions import get_logger
+from functions import get_cache_dir, get_logger
 
 load_dotenv()
 
@@ -16,102 +22,425 @@ HEADERS = {
     "Authorization": f"token {GITHUB_TOKEN}"
 }
 
+# Concurrency and rate limit handling. MAX_WORKERS is shared by all topics fetched at once
+MAX_WORKERS = int(os.getenv("GITHUB_MAX_WORKERS", 4))
+MAX_RETRIES = 5
+# Below this many remaining requests, requests are spread out over the time left until the reset
+RATE_LIMIT_LOW_WATERMARK = 5
+
+# Repository metadata we keep from the search results: column -> (extractor, column type)
+REPO_FIELDS = {
+    "name": (lambda repo: repo.get("name"), "str"),
+    "full_name": (lambda repo: repo.get("full_name"), "str"),
+    "owner_login": (lambda repo: (repo.get("owner") or {}).get("login"), "category"),
+    "description": (lambda repo: repo.get("description"), "str"),
+    "html_url": (lambda repo: repo.get("html_url"), "str"),
+    "clone_url": (lambda repo: repo.get("clone_url"), "str"),
+    "stars": (lambda repo: repo.get("stargazers_count"), "int"),
+    "forks": (lambda repo: repo.get("forks_count"), "int"),
+    "language": (lambda repo: repo.get("language"), "category"),
+    "created_at": (lambda repo: repo.get("created_at"), "datetime"),
+    "updated_at": (lambda repo: repo.get("updated_at"), "datetime"),
+    "pushed_at": (lambda repo: repo.get("pushed_at"), "datetime"),
+    "license": (lambda repo: (repo.get("license") or {}).get("spdx_id"), "category"),
+    "has_issues": (lambda repo: repo.get("has_issues"), "bool"),
+    "has_projects": (lambda repo: repo.get("has_projects"), "bool"),
+    "has_downloads": (lambda repo: repo.get("has_downloads"), "bool"),
+    "has_wiki": (lambda repo: repo.get("has_wiki"), "bool"),
+    "homepage": (lambda repo: repo.get("homepage"), "str"),
+    "topics": (lambda repo: repo.get("topics", []), "list"),
+}
+
+# GraphQL enrichment: repositories per query (GitHub allows up to 100 top-level nodes, 50 keeps queries cheap)
+GRAPHQL_URL = f"{BASE_URL}/graphql"
+GRAPHQL_BATCH_SIZE = 50
+REPO_DETAILS_FRAGMENT = """
+fragment details on Repository {
+  releases { totalCount }
+  latestRelease { tagName publishedAt }
+  issues(states: OPEN) { totalCount }
+  pullRequests(states: OPEN) { totalCount }
+  mentionableUsers { totalCount }
+  defaultBranchRef { target { ... on Commit { committedDate history { totalCount } } } }
+}
+"""
+
+# On-disk response cache (ETag revalidation), limited by age and total size
+CACHE_MAX_AGE_SECONDS = int(os.getenv("GITHUB_CACHE_MAX_AGE_DAYS", 7)) * 24 * 3600
+CACHE_MAX_BYTES = int(os.getenv("GITHUB_CACHE_MAX_MB", 50)) * 1024 * 1024
+
 mylogger = get_logger()
 
+# Topics collect_metrics() fetches at the same time
+TOPICS = ("scripture-open-apps", "scripture-open-components")
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_throttle_lock = threading.Lock()
+_resume_at = 0.0
+_cache_lock = threading.Lock()
+
+def get_session():
+    """
+    Returns the shared requests.Session, with a connection pool big enough for the MAX_WORKERS
+    shared workers plus one thread per topic fetching its first page, so all requests reuse
+    kept-alive connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers.update(HEADERS)
+            pool_size = MAX_WORKERS + len(TOPICS)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("https://", adapter)
+    return _session
+
+def get_executor():
+    """
+    Returns the thread pool shared by all page fetches and GraphQL batches, so topics
+    fetched at the same time together stay within MAX_WORKERS concurrent requests.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="github")
+    return _executor
+
+def _rate_limit_wait(response):
+    """
+    Seconds to wait before the next request, based on GitHub's rate limit headers.
+    Retry-After wins (secondary rate limits), then X-RateLimit-Remaining/Reset.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        return float(retry_after)
+
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return 0
+    seconds_to_reset = max(float(reset) - time.time(), 0) + 1
+    remaining = int(remaining)
+    if remaining == 0:
+        return seconds_to_reset
+    if remaining < RATE_LIMIT_LOW_WATERMARK:
+        # Adaptive throttling: spread what's left over the rest of the window
+        return seconds_to_reset / remaining
+    return 0
+
+def _pause(seconds):
+    """Hold back every worker for `seconds`, e.g. when the rate limit is (almost) used up."""
+    global _resume_at
+    with _throttle_lock:
+        _resume_at = max(_resume_at, time.monotonic() + seconds)
+
+def _wait_for_resume():
+    with _throttle_lock:
+        delay = _resume_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def github_get(url, headers=None):
+    """
+    GETs a GitHub API url, honoring the rate limit headers and retrying rate limited (403/429)
+    and server errors. Raises when the request keeps failing, instead of returning partial data.
+    A 304 (Not Modified) is returned as is.
+    """
+    return github_request("GET", url, headers=headers)
+
+def github_request(method, url, headers=None, json=None):
+    """See github_get, for any HTTP method (e.g. POST to the GraphQL API)."""
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        _wait_for_resume()
+        response = session.request(method, url, headers=headers, json=json)
+        wait = _rate_limit_wait(response)
+
+        if response.status_code in (200, 304):
+            if wait:
+                mylogger.debug(f"GitHub rate limit is running low, throttling for {wait:.1f}s")
+                _pause(wait)
+            return response
+
+        rate_limited = response.status_code in (403, 429) and (wait or "rate limit" in response.text.lower())
+        if attempt < MAX_RETRIES and (rate_limited or response.status_code >= 500):
+            wait = wait or 2 ** attempt
+            mylogger.warning(f"GitHub request failed with {response.status_code}, retrying in {wait:.1f}s")
+            _pause(wait)
+            continue
+
+        response.raise_for_status()
+        raise requests.HTTPError(f"Unexpected status {response.status_code} for {url}", response=response)
+
+def _cache_file(url):
+    return os.path.join(get_cache_dir("github"), sha1(url.encode("utf-8")).hexdigest() + ".pkl")
+
+def _read_cache_entry(url):
+    cache_file = _cache_file(url)
+    # The other topic's prune_cache() may remove the file at any point, which is just a cache miss
+    try:
+        if time.time() - os.path.getmtime(cache_file) > CACHE_MAX_AGE_SECONDS:
+            return None
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+def _write_cache_entry(url, entry):
+    # Write to a temp file first, so a concurrent reader never sees a half-written entry
+    cache_file = _cache_file(url)
+    tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        mylogger.warning(f"Could not cache GitHub response for {url}: {e}")
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+def prune_cache():
+    """Drop cache entries older than CACHE_MAX_AGE_SECONDS, then the oldest ones until under CACHE_MAX_BYTES."""
+    cache_dir = get_cache_dir("github")
+    with _cache_lock:
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if time.time() - stat.st_mtime > CACHE_MAX_AGE_SECONDS:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:  # e.g. a temp file that was just renamed
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+def get_json(url):
+    """
+    GETs a GitHub API url and returns (decoded json, links), using the on-disk response cache.
+    Cached entries are revalidated with If-None-Match: a 304 doesn't count against the rate limit,
+    and saves us decoding the body again.
+    """
+    entry = _read_cache_entry(url)
+    headers = {"If-None-Match": entry["etag"]} if entry else None
+    response = github_get(url, headers=headers)
+
+    if response.status_code == 304:
+        # Still valid, so restart its age (unless it was just pruned by another crawl)
+        try:
+            os.utime(_cache_file(url))
+        except OSError:
+            pass
+        return entry["data"], entry["links"]
+
+    data = response.json()
+    etag = response.headers.get("ETag")
+    if etag:
+        _write_cache_entry(url, {"etag": etag, "data": data, "links": response.links})
+    return data, response.links
+
+def _last_page(links):
+    """Number of the last page, from the Link header (1 if there is only one page)."""
+    last = links.get("last", {}).get("url")
+    if not last:
+        return 1
+    return int(parse_qs(urlparse(last).query).get("page", ["1"])[0])
+
+def iter_repo_pages(topic, per_page=100):
+    """
+    Yields the repositories associated with a given topic (GitHub Search API), one page at a time and in order.
+    The first page tells us the last page (Link header), the rest is fetched concurrently.
+    """
+    url = f"{BASE_URL}/search/repositories?q=topic:{topic}&per_page={per_page}&page={{page}}"
+    mylogger.debug("Fetching page 1...")
+    data, links = get_json(url.format(page=1))
+    yield data.get("items", [])
+
+    last_page = _last_page(links)
+    if last_page > 1:
+        mylogger.debug(f"Fetching pages 2 to {last_page}...")
+        # map() keeps the page order
+        for data, _ in get_executor().map(get_json, [url.format(page=page) for page in range(2, last_page + 1)]):
+            yield data.get("items", [])
+
+    prune_cache()
+
 def get_repos_by_topic(topic, per_page=100):
     """
     Fetches repositories associated with a given topic using the GitHub Search API.
     Handles pagination.
     """
-    all_repos_data = []
-    page = 1
-    while True:
-        url = f"{BASE_URL}/search/repositories?q=topic:{topic}&per_page={per_page}&page={page}"
-        mylogger.debug(f"Fetching page {page}...")
-        response = requests.get(url, headers=HEADERS)
-
-        if response.status_code == 200:
-            data = response.json()
-            items = data.get("items", [])
-            all_repos_data.extend(items)
-
-            # Check for pagination
-            if "next" in response.links:
-                page += 1
-            else:
-                break
-        else:
-            mylogger.error(f"Could not fetch data: {response.status_code} - {response.text}")
-            break
+    return [repo for page in iter_repo_pages(topic, per_page) for repo in page]
 
-    return all_repos_data
+class RepoColumns:
+    """
+    Columnar builder for repository metadata: every page of search results is appended straight into
+    one buffer per column, and the buffers are turned into typed columns (nullable ints/booleans,
+    categoricals, datetime64) once, in to_frame().
+    Only the given fields are extracted (default: all of REPO_FIELDS).
+    """
+    def __init__(self, fields=None):
+        self.fields = list(fields or REPO_FIELDS)
+        unknown = set(self.fields) - set(REPO_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown repository field(s): {', '.join(sorted(unknown))}")
+        self._buffers = {field: [] for field in self.fields}
+
+    def __len__(self):
+        return len(self._buffers[self.fields[0]])
+
+    def append_page(self, items):
+        for field in self.fields:
+            extract, _ = REPO_FIELDS[field]
+            self._buffers[field].extend(extract(item) for item in items)
+
+    def to_frame(self):
+        columns = {}
+        for field in self.fields:
+            _, kind = REPO_FIELDS[field]
+            values = self._buffers[field]
+            if kind == "int":
+                columns[field] = pd.array(values, dtype="Int64")
+            elif kind == "bool":
+                columns[field] = pd.array(values, dtype="boolean")
+            elif kind == "category":
+                columns[field] = pd.Categorical(values)
+            elif kind == "datetime":
+                columns[field] = pd.to_datetime(values, utc=True)
+            else:
+                columns[field] = values
+        return pd.DataFrame(columns)
 
 def get_repo_details(owner, repo_name):
     """
     Fetches detailed metadata for a specific repository.
+    One request per repository: use enrich_repos() to add details to many repositories at once.
     """
     url = f"{BASE_URL}/repos/{owner}/{repo_name}"
-    response = requests.get(url, headers=HEADERS)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        mylogger.error(f"Could not fetch details for {owner}/{repo_name}: {response.status_code} - {response.text}")
+    try:
+        response = github_get(url)
+    except requests.HTTPError as e:
+        mylogger.error(f"Could not fetch details for {owner}/{repo_name}: {e.response.status_code} - {e.response.text}")
         return None
+    return response.json()
 
-def main(TOPIC):
-    mylogger.debug(f"Searching for repositories with topic: '{TOPIC}'")
-    repos_summary = get_repos_by_topic(TOPIC)
-    mylogger.debug(f"Found {len(repos_summary)} repositories with topic '{TOPIC}'.")
+def _graphql_batch(repos):
+    """Fetches REPO_DETAILS_FRAGMENT for a batch of (owner, name) tuples, in one GraphQL query."""
+    variables = {}
+    selections = []
+    for i, (owner, name) in enumerate(repos):
+        variables[f"o{i}"] = owner
+        variables[f"n{i}"] = name
+        selections.append(f"r{i}: repository(owner: $o{i}, name: $n{i}) {{ ...details }}")
+    arguments = ", ".join(f"$o{i}: String!, $n{i}: String!" for i in range(len(repos)))
+    query = f"query({arguments}) {{ {' '.join(selections)} }}\n{REPO_DETAILS_FRAGMENT}"
 
-    if not repos_summary:
-        mylogger.info(f"No repositories found for the given topic of {TOPIC}")
-        return
+    result = github_request("POST", GRAPHQL_URL, json={"query": query, "variables": variables}).json()
+    errors = result.get("errors", [])
+    data = result.get("data")
+    if not data:
+        # The whole query failed (e.g. a token missing a scope), not just some repositories
+        messages = "; ".join(error.get("message", "") for error in errors) or "no data returned"
+        raise RuntimeError(f"GitHub GraphQL query failed: {messages}")
+    for error in errors:
+        # e.g. a repository that was renamed or deleted since the search; its alias comes back as null
+        mylogger.warning(f"GraphQL error: {error.get('message')}")
+
+    rows = []
+    for i in range(len(repos)):
+        repo = data.get(f"r{i}") or {}
+        commit = (repo.get("defaultBranchRef") or {}).get("target") or {}
+        latest_release = repo.get("latestRelease") or {}
+        rows.append({
+            "release_count": (repo.get("releases") or {}).get("totalCount"),
+            "open_issue_count": (repo.get("issues") or {}).get("totalCount"),
+            "open_pr_count": (repo.get("pullRequests") or {}).get("totalCount"),
+            # GraphQL has no contributor list; users who can be mentioned (collaborators/contributors) come closest
+            "mentionable_user_count": (repo.get("mentionableUsers") or {}).get("totalCount"),
+            "commit_count": (commit.get("history") or {}).get("totalCount"),
+            "last_commit_at": commit.get("committedDate"),
+            "latest_release_tag": latest_release.get("tagName"),
+            "latest_release_at": latest_release.get("publishedAt"),
+        })
+    return rows
+
+def enrich_repos(df, batch_size=GRAPHQL_BATCH_SIZE):
+    """
+    Adds detail columns (releases, open issues/PRs, last commit, ...) to a DataFrame from main(),
+    with one GraphQL request per `batch_size` repositories instead of one REST request per repository.
+    """
+    repos = list(zip(df["owner_login"], df["name"]))
+    batches = [repos[start:start + batch_size] for start in range(0, len(repos), batch_size)]
+
+    rows = []
+    for batch_rows in get_executor().map(_graphql_batch, batches):
+        rows.extend(batch_rows)
+
+    details = pd.DataFrame(rows, index=df.index)
+    for col in ("release_count", "open_issue_count", "open_pr_count", "mentionable_user_count", "commit_count"):
+        details[col] = details[col].astype("Int64")
+    for col in ("last_commit_at", "latest_release_at"):
+        details[col] = pd.to_datetime(details[col], utc=True)
+    return pd.concat([df, details], axis=1)
 
-    # Extract relevant metadata and store in a list of dictionaries
-    repo_metadata_list = []
-    for repo_sum in repos_summary:
+def main(TOPIC, enrich=False, fields=None):
+    """
+    Returns a DataFrame with the metadata of all repositories with the given topic (None if there are none).
+    Pass `fields` to only keep the REPO_FIELDS a caller needs.
+    """
+    if enrich and fields is not None:
+        # enrich_repos() needs to know which repositories to look up
+        fields = list(dict.fromkeys(["owner_login", "name"] + list(fields)))
+
+    mylogger.debug(f"Searching for repositories with topic: '{TOPIC}'")
+    repo_columns = RepoColumns(fields)
+    for page in iter_repo_pages(TOPIC):
         # The search API provides a good amount of metadata directly.
         # You can enrich this with more detailed calls if needed.
-        repo_data = {
-            "name": repo_sum.get("name"),
-            "full_name": repo_sum.get("full_name"),
-            "owner_login": repo_sum.get("owner", {}).get("login"),
-            "description": repo_sum.get("description"),
-            "html_url": repo_sum.get("html_url"),
-            "clone_url": repo_sum.get("clone_url"),
-            "stars": repo_sum.get("stargazers_count"),
-            "forks": repo_sum.get("forks_count"),
-            "language": repo_sum.get("language"),
-            "created_at": repo_sum.get("created_at"),
-            "updated_at": repo_sum.get("updated_at"),
-            "pushed_at": repo_sum.get("pushed_at"),
-            "license": repo_sum.get("license", {}).get("spdx_id") if repo_sum.get("license") else None,
-            "has_issues": repo_sum.get("has_issues"),
-            "has_projects": repo_sum.get("has_projects"),
-            "has_downloads": repo_sum.get("has_downloads"),
-            "has_wiki": repo_sum.get("has_wiki"),
-            "homepage": repo_sum.get("homepage"),
-            "topics": repo_sum.get("topics", [])
-        }
-        repo_metadata_list.append(repo_data)
+        repo_columns.append_page(page)
+    mylogger.debug(f"Found {len(repo_columns)} repositories with topic '{TOPIC}'.")
+
+    if not len(repo_columns):
+        mylogger.info(f"No repositories found for the given topic of {TOPIC}")
+        return
 
     # Convert to Pandas DataFrame
-    df = pd.DataFrame(repo_metadata_list)
+    df = repo_columns.to_frame()
+    if enrich:
+        df = enrich_repos(df)
     mylogger.info(f"DataFrame successfully created for {TOPIC}: {df.shape[0]} rows captured")
     return df
 
 if __name__ == "__main__":
-   open_app_github_df = main("scripture-open-apps")
-   open_components_github_df = main("scripture-open-components")
+   open_app_github_df = main(TOPICS[0])
+   open_components_github_df = main(TOPICS[1])
 
 def collect_metrics() -> dict:
     """
     Runs the GitHub scrapers for scripture-open-apps and scripture-open-components
     and returns summary counts.
     """
-    # Re-use your main() to pull the two topics
-    open_app_github_df = main("scripture-open-apps")
-    open_components_github_df = main("scripture-open-components")
+    # Re-use your main() to pull the two topics, both at once. Their page fetches share get_executor()
+    with ThreadPoolExecutor(max_workers=len(TOPICS)) as executor:
+        open_app_future = executor.submit(main, TOPICS[0], fields=["owner_login"])
+        open_components_future = executor.submit(main, TOPICS[1], fields=["owner_login"])
+        open_app_github_df = open_app_future.result()
+        open_components_github_df = open_components_future.result()
 
     if open_app_github_df is None or open_components_github_df is None:
         return {
@@ -1,5 +1,6 @@
 import gspread
 import os
+import threading
 from gspread_dataframe import get_as_dataframe
 from google.oauth2 import service_account
 from functions import get_logger
@@ -27,54 +28,68 @@ SPREADSHEET_NAME = os.getenv('OPEN_RESOURCE_SPREADSHEET_NAME')  # Replace with y
 # Name or index (0-based) of the worksheet you want to read
 WORKSHEET_NAME = os.getenv('WORKSHEET_NAME') # Replace with your worksheet's name, or use index (e.g., 0 for the first sheet)
 
-# --- Authentication ---
+# Count the partners from a single key column (filled in on every partner row) instead of downloading the whole sheet
+LIGHTWEIGHT_COUNT = os.getenv('OPEN_RESOURCE_LIGHTWEIGHT_COUNT', '1') == '1'
+KEY_COLUMN = os.getenv('OPEN_RESOURCE_KEY_COLUMN', 'A')
 
-try:
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE,
-        scopes=SCOPE,  # same scopes you used before
-    )
-    client = gspread.authorize(creds)
-    mylogger.info("Authentication successful!")
-except Exception as e:
-    mylogger.critical(f"Authentication failed: {e}")
-    mylogger.critical("Please ensure your SERVICE_ACCOUNT_FILE path is correct and the JSON file is valid.")
-    mylogger.critical("Also, check if the Google Sheets API and Google Drive API are enabled in your Google Cloud Project.")
-    exit()
+# --- Authentication ---
+# The authorized client is created on first use and shared by the whole process,
+# so importing this module doesn't touch the network
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns the process-wide authorized gspread client, authenticating on the first call."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            creds = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE,
+                scopes=SCOPE,  # same scopes you used before
+            )
+            _client = gspread.authorize(creds)
+            mylogger.info("Authentication successful!")
+    return _client
 
 # --- Accessing and Reading Data ---
-try:
-    spreadsheet = client.open(SPREADSHEET_NAME)
-    worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
+def get_worksheet(spreadsheet_name=SPREADSHEET_NAME, worksheet_name=WORKSHEET_NAME):
+    """Opens a worksheet of a spreadsheet, by their names."""
+    spreadsheet = get_client().open(spreadsheet_name)
+    return spreadsheet.worksheet(worksheet_name)
 
+def fetch_worksheet_dataframe(spreadsheet_name=SPREADSHEET_NAME, worksheet_name=WORKSHEET_NAME):
+    """Downloads a worksheet into a Pandas DataFrame."""
     # To get all records as a list of dictionaries (useful for debugging)
     # records = worksheet.get_all_records()
     # print(records)
 
     # Get the data directly into a Pandas DataFrame
     # get_as_dataframe handles headers and empty rows/columns nicely.
-    df = get_as_dataframe(worksheet)
-
-    mylogger.info(f"Successfully pulled data from '{SPREADSHEET_NAME}' spreadsheet: with {df.shape[0]} rows pulled.")
-
-except gspread.exceptions.SpreadsheetNotFound:
-    mylogger.error(f"Error: Spreadsheet '{SPREADSHEET_NAME}' not found. Check the name and sharing permissions.")
-except gspread.exceptions.WorksheetNotFound:
-    mylogger.error(f"Error: Worksheet '{WORKSHEET_NAME}' not found in '{SPREADSHEET_NAME}'. Check the name.")
-except Exception as e:
-    mylogger.exception(f"An unexpected error occurred: {e}")
+    return get_as_dataframe(get_worksheet(spreadsheet_name, worksheet_name))
 
-def collect_metrics() -> dict:
+def count_rows(spreadsheet_name=SPREADSHEET_NAME, worksheet_name=WORKSHEET_NAME, key_column=KEY_COLUMN):
+    """
+    Counts the rows below the header that have a value in key_column, fetching only that column.
+    The API already leaves out the empty rows after the last value.
+    """
+    worksheet = get_worksheet(spreadsheet_name, worksheet_name)
+    # Unevaluated, like get_as_dataframe: a formula counts even when it evaluates to an empty string
+    values = worksheet.get(f"{key_column}2:{key_column}", major_dimension="COLUMNS",
+                           value_render_option=gspread.utils.ValueRenderOption.formula)
+    column = values[0] if values else []
+    return sum(1 for value in column if str(value).strip())
+
+def collect_metrics(lightweight=LIGHTWEIGHT_COUNT) -> dict:
     """
     Connects to the Google Sheet and returns the number of open resource partners.
+    With lightweight set only the key column is fetched, otherwise the whole worksheet.
     Returns a dict of the form: {"open_resource_partners": <int>}
     """
     try:
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-
-        df = get_as_dataframe(worksheet)
-        open_resource_partners = len(df)
+        if lightweight:
+            open_resource_partners = count_rows()
+        else:
+            open_resource_partners = len(fetch_worksheet_dataframe())
 
         return {"open_resource_partners": open_resource_partners}
     except Exception as e:
@@ -83,3 +98,25 @@ def collect_metrics() -> dict:
             "error_message": str(e),
             "open_resource_partners": None
         }
+
+
+if __name__ == '__main__':
+    try:
+        get_client()
+    except Exception as e:
+        mylogger.critical(f"Authentication failed: {e}")
+        mylogger.critical("Please ensure your SERVICE_ACCOUNT_FILE path is correct and the JSON file is valid.")
+        mylogger.critical("Also, check if the Google Sheets API and Google Drive API are enabled in your Google Cloud Project.")
+        raise SystemExit(1)
+
+    try:
+        df = fetch_worksheet_dataframe()
+
+        mylogger.info(f"Successfully pulled data from '{SPREADSHEET_NAME}' spreadsheet: with {df.shape[0]} rows pulled.")
+
+    except gspread.exceptions.SpreadsheetNotFound:
+        mylogger.error(f"Error: Spreadsheet '{SPREADSHEET_NAME}' not found. Check the name and sharing permissions.")
+    except gspread.exceptions.WorksheetNotFound:
+        mylogger.error(f"Error: Worksheet '{WORKSHEET_NAME}' not found in '{SPREADSHEET_NAME}'. Check the name.")
+    except Exception as e:
+        mylogger.exception(f"An unexpected error occurred: {e}")
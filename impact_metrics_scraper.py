@@ -2,42 +2,43 @@
 import os
 import sys
 import json
+import asyncio
 import importlib
 import subprocess
+import threading
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import Any, Callable, Dict, List, Optional
 
 import pandas as pd
-from sqlalchemy import create_engine
 from sqlalchemy.types import Integer, Date
-from functions import get_logger
+from functions import get_engine, get_logger
+import instrumentation
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # ========= CONFIG =========
 
-# MariaDB connection via env vars
-DB_USER = os.getenv("TDB_USER")
-DB_PASSWORD = os.getenv("TDB_PASSWORD")
-DB_NAME = os.getenv("TDB_DB")
-DB_HOST = os.getenv("TDB_HOST")
-#DB_URI = f"mariadb+mariadbconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
-DB_URI = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}?charset=utf8mb4"
-
 # How to pull results from each script (we’ll call a small function that returns a dict)
+# timeout (seconds) is generous headroom over a normal run; it is only enforced in concurrent mode
 ORCHESTRATIONS = [
     # 1) Run-only ingestion: updates positive_pr table (no metrics returned)
-    {"name": "imports_positive_pr", "mode": "cli_run", "as_module": False},
+    {"name": "imports_positive_pr", "mode": "cli_run", "as_module": False, "timeout": 1800},
 
     # 2) Then collect metrics (these return dicts):
-    {"name": "white_pages_scraper",   "mode": "call_func", "callable_name": "collect_metrics"},
-    {"name": "github_scraper",        "mode": "call_func", "callable_name": "collect_metrics"},
-    {"name": "google_sheets_scraper", "mode": "call_func", "callable_name": "collect_metrics"},
-    {"name": "FRED_scraper",          "mode": "call_func", "callable_name": "collect_metrics"},
+    {"name": "white_pages_scraper",   "mode": "call_func", "callable_name": "collect_metrics", "timeout": 300},
+    {"name": "github_scraper",        "mode": "call_func", "callable_name": "collect_metrics", "timeout": 600},
+    {"name": "google_sheets_scraper", "mode": "call_func", "callable_name": "collect_metrics", "timeout": 120},
+    # FRED counts positive_pr, so it has to wait for the ingestion above when running concurrently
+    {"name": "FRED_scraper",          "mode": "call_func", "callable_name": "collect_metrics", "timeout": 600,
+     "depends_on": ["imports_positive_pr"]},
 ]
 
+# Run the collectors concurrently (honoring depends_on), instead of one after another
+CONCURRENT = os.getenv("IMPACT_METRICS_CONCURRENT", "false").lower() == "true"
+MAX_WORKERS = int(os.getenv("IMPACT_METRICS_MAX_WORKERS", 8))
+
 # Explicit dtypes (keeps MariaDB schema consistent)
 EXPLICIT_DTYPES = {
     # white_pages_scraper
@@ -78,6 +79,8 @@ class ScriptSpec:
     variable: Optional[str] = None
     callable_name: Optional[str] = None
     as_module: Optional[bool] = None  # for cli_json (optional mode)
+    timeout: Optional[float] = None  # seconds, only enforced in concurrent mode
+    depends_on: Optional[List[str]] = None  # collectors that must finish first (concurrent mode)
 
 def _import_module(module_name: str):
     return importlib.import_module(module_name)
@@ -126,13 +129,16 @@ def _extract_cli_json(spec: ScriptSpec) -> Dict[str, Any]:
         raise RuntimeError(f"{spec.name}: non-zero exit {proc.returncode}\nSTDERR:\n{proc.stderr}")
     return _expect_dict(json.loads(proc.stdout.strip()), spec.name)
 
+def _cli_run_command(spec: ScriptSpec) -> List[str]:
+    # If as_module=True: python -m <module>; else: python <path-or-file>
+    return [sys.executable, "-m", spec.name] if spec.as_module else [sys.executable, f"{spec.name}.py"]
+
 def _run_cli(spec: ScriptSpec) -> Dict[str, Any]:
     """
     Execute a script and return no metrics (empty dict).
     Use when a script performs ingestion/side effects in its __main__ block.
     """
-    # If as_module=True: python -m <module>; else: python <path-or-file>
-    cmd = [sys.executable, "-m", spec.name] if spec.as_module else [sys.executable, f"{spec.name}.py"]
+    cmd = _cli_run_command(spec)
     proc = subprocess.run(cmd, capture_output=True, text=True)
     if proc.returncode != 0:
         raise RuntimeError(
@@ -150,6 +156,33 @@ MODE_HANDLERS = {
     "cli_run": _run_cli,          # <— NEW
 }
 
+async def _run_cli_async(spec: ScriptSpec) -> Dict[str, Any]:
+    """
+    Async variant of _run_cli, so a subprocess doesn't tie up a worker thread.
+    The subprocess is killed when the collector is cancelled (e.g. on timeout).
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *_cli_run_command(spec), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    stdout, stderr = stdout.decode(errors="replace"), stderr.decode(errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"{spec.name}: exit {proc.returncode}\nSTDERR:\n{stderr}\nSTDOUT:\n{stdout}"
+        )
+    if stdout.strip():
+        mylogger.debug(f"[{spec.name} stdout]\n{stdout}")
+    return {}
+
+ASYNC_MODE_HANDLERS = {
+    "cli_run": _run_cli_async,
+}
+
 def _merge_metrics(rows_by_script: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
     """
     Merge all metric dicts into a single dict. If any duplicate keys exist across scripts,
@@ -169,28 +202,130 @@ def _merge_metrics(rows_by_script: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
             key_owner[k] = script
     return merged
 
-def run_all(orchestrations: List[Dict[str, Any]]) -> pd.DataFrame:
-    run_date = datetime.now(timezone.utc).date()  # date only
-    collected: Dict[str, Dict[str, Any]] = {}
-    errors: Dict[str, str] = {}
+def _log_outcome(spec: ScriptSpec, outcome: Dict[str, Any]) -> None:
+    if "error" in outcome:
+        mylogger.error(f"{spec.name}: {outcome['error']}")
+    else:
+        mylogger.info(f"{spec.name}: collected {len(outcome['payload'] or {})} fields")
 
-    # Execute each collector
-    for spec_dict in orchestrations:
-        spec = ScriptSpec(**spec_dict)
+def _measured(handler: Callable, spec: ScriptSpec) -> Dict[str, Any]:
+    with instrumentation.measure(spec.name):
+        return handler(spec)
+
+async def _measured_async(handler: Callable, spec: ScriptSpec) -> Dict[str, Any]:
+    with instrumentation.measure(spec.name):
+        return await handler(spec)
+
+def _run_in_daemon_thread(loop: asyncio.AbstractEventLoop, func: Callable, *args) -> asyncio.Future:
+    """
+    Run func in a daemon thread and return a future for its result. Unlike a thread pool worker,
+    a daemon thread isn't joined at interpreter exit, so a collector abandoned after its timeout
+    can't keep the process alive. Threads the collector starts itself are still joined, though.
+    """
+    future = loop.create_future()
+
+    def resolve(result=None, exception=None):
+        if future.done():  # cancelled, e.g. on timeout
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            outcome = {"exception": e}
+        else:
+            outcome = {"result": result}
+        try:
+            loop.call_soon_threadsafe(lambda: resolve(**outcome))
+        except RuntimeError:  # the loop is closed: the run already finished without us
+            pass
+
+    threading.Thread(target=target, name=f"collector-{args[-1].name}", daemon=True).start()
+    return future
+
+def _run_sequential(specs: List[ScriptSpec]) -> Dict[str, Dict[str, Any]]:
+    """Run the collectors one after another. Returns {name: {"payload": ...} or {"error": ...}}."""
+    outcomes: Dict[str, Dict[str, Any]] = {}
+    for spec in specs:
         handler = MODE_HANDLERS.get(spec.mode)
 
         mylogger.info(f"- Starting '{spec.name}' collector ")
 
         if handler is None:
-            errors[spec.name] = f"Unknown mode '{spec.mode}'"
+            outcomes[spec.name] = {"error": f"Unknown mode '{spec.mode}'"}
             continue
         try:
-            payload = handler(spec)
-            collected[spec.name] = payload or {}
-            mylogger.info(f"{spec.name}: collected {len(payload or {})} fields")
+            outcomes[spec.name] = {"payload": _measured(handler, spec)}
         except Exception as e:
-            errors[spec.name] = str(e)
-            mylogger.error(f"{spec.name}: {e}")
+            outcomes[spec.name] = {"error": str(e)}
+        _log_outcome(spec, outcomes[spec.name])
+    return outcomes
+
+async def _run_concurrent(specs: List[ScriptSpec], max_workers: int) -> Dict[str, Dict[str, Any]]:
+    """
+    Run all collectors at once: call_func (and other blocking modes) in daemon threads, at most
+    max_workers at a time, and cli_run as async subprocesses. A collector starts once everything in its
+    depends_on has finished (successfully or not). After its timeout it is abandoned: a subprocess is
+    killed, a thread is left to finish (or die with the process) while the run carries on.
+    """
+    loop = asyncio.get_running_loop()
+    tasks: Dict[str, asyncio.Task] = {}
+    worker_slots = asyncio.Semaphore(max_workers)
+
+    async def run_one(spec: ScriptSpec) -> Dict[str, Any]:
+        for dependency in spec.depends_on or []:
+            if dependency in tasks:
+                await asyncio.wait([tasks[dependency]])
+
+        mylogger.info(f"- Starting '{spec.name}' collector ")
+
+        if spec.mode not in ASYNC_MODE_HANDLERS and spec.mode not in MODE_HANDLERS:
+            return {"error": f"Unknown mode '{spec.mode}'"}
+        async with worker_slots:
+            if spec.mode in ASYNC_MODE_HANDLERS:
+                work = _measured_async(ASYNC_MODE_HANDLERS[spec.mode], spec)
+            else:
+                work = _run_in_daemon_thread(loop, _measured, MODE_HANDLERS[spec.mode], spec)
+            try:
+                outcome = {"payload": await asyncio.wait_for(work, timeout=spec.timeout)}
+            except asyncio.TimeoutError:
+                outcome = {"error": f"timed out after {spec.timeout}s"}
+            except Exception as e:
+                outcome = {"error": str(e)}
+        _log_outcome(spec, outcome)
+        return outcome
+
+    for spec in specs:
+        tasks[spec.name] = asyncio.create_task(run_one(spec))
+    results = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks.keys(), results))
+
+def run_all(orchestrations: List[Dict[str, Any]], concurrent: bool = False,
+            max_workers: int = MAX_WORKERS) -> pd.DataFrame:
+    run_date = datetime.now(timezone.utc).date()  # date only
+    collected: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, str] = {}
+
+    specs = [ScriptSpec(**spec_dict) for spec_dict in orchestrations]
+    instrumentation.reset()
+
+    # Execute each collector
+    if concurrent:
+        outcomes = asyncio.run(_run_concurrent(specs, max_workers))
+    else:
+        outcomes = _run_sequential(specs)
+
+    # Collect results in orchestration order, so the combined row is the same in both modes
+    for spec in specs:
+        outcome = outcomes[spec.name]
+        if "error" in outcome:
+            errors[spec.name] = outcome["error"]
+        else:
+            collected[spec.name] = outcome["payload"] or {}
 
     # Merge into a single row of metrics
     merged_metrics: Dict[str, Any] = {}
@@ -222,22 +357,40 @@ def write_to_mariadb(df: pd.DataFrame, table: str, if_exists: str = "append") ->
     df = df.copy()
     df.columns = [c.replace(" ", "_") for c in df.columns]
 
-    engine = create_engine(DB_URI, pool_pre_ping=True, pool_recycle=3600)
-    try:
-        df.to_sql(
-            name=table,
-            con=engine,
-            if_exists=if_exists,   # 'append' in prod; 'replace' only when resetting
-            index=False,
-            dtype=_dtype_map_for(df),
-            method="multi",
-            chunksize=1000,
+    df.to_sql(
+        name=table,
+        con=get_engine(),
+        if_exists=if_exists,   # 'append' in prod; 'replace' only when resetting
+        index=False,
+        dtype=_dtype_map_for(df),
+        method="multi",
+        chunksize=1000,
+    )
+    mylogger.info(f"Wrote 1 combined row to {table}")
+
+def write_timings(df: pd.DataFrame, table: str, if_exists: str = "append") -> None:
+    """Write the per-collector stats of a run (see instrumentation.py) to a sibling table."""
+    timings = instrumentation.collected_stats()
+    if timings.empty:
+        return
+    timings.insert(0, "run_ts", df["run_ts"].iloc[0])
+    for row in timings.itertuples():
+        mylogger.info(
+            f"{row.collector}: {row.wall_time:.2f}s wall, {row.cpu_time:.2f}s cpu, "
+            f"{row.http_requests} HTTP requests ({row.http_bytes} bytes), "
+            f"{row.db_queries} DB queries ({row.db_rows} rows)"
         )
-        mylogger.info(f"Wrote 1 combined row to {table}")
-    finally:
-        engine.dispose()
+    timings.to_sql(
+        name=table,
+        con=get_engine(),
+        if_exists=if_exists,
+        index=False,
+        dtype=instrumentation.TIMINGS_DTYPES,
+        method="multi",
+    )
 
 if __name__ == "__main__":
-    df = run_all(ORCHESTRATIONS)
+    df = run_all(ORCHESTRATIONS, concurrent=CONCURRENT)
     mylogger.info(f"Produced columns: {list(df.columns)}")
     write_to_mariadb(df, "impact_model_metrics", if_exists="append")
+    write_timings(df, "impact_model_metrics_timings", if_exists="append")
@@ -1,4 +1,3 @@
-from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
 import os
 import datetime as dt
@@ -12,7 +11,7 @@ from eventregistry import (
     ArticleInfoFlags,
     SourceInfoFlags,
 )
-from functions import get_logger
+from functions import get_engine, get_logger
 
 load_dotenv()
 
@@ -142,22 +141,9 @@ if __name__ == "__main__":
 
     mylogger.debug("Loading internal data tables into pipeline.")
 
-    # Initialize engine object to None
-    engine = None
-
     try:
-        # Get database credentials from environment variables
-        db_user = os.getenv("TDB_USER")
-        db_password = os.getenv("TDB_PASSWORD")
-        db_name = os.getenv("TDB_DB")
-        db_host = os.getenv("TDB_HOST")
-
-        # Construct the database URI for SQLAlchemy using the MariaDB dialect
-#        db_uri = f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_host}/{db_name}"
-        db_uri = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}?charset=utf8mb4"
-
-        # Create a SQLAlchemy engine
-        engine = create_engine(db_uri, pool_pre_ping=True, pool_recycle=3600)
+        # Borrow the shared SQLAlchemy engine
+        engine = get_engine()
 
         # Test the connection by trying to connect
         with engine.connect() as connection:
@@ -183,7 +169,3 @@ if __name__ == "__main__":
         mylogger.error(f"Database Error: {err}")
     except Exception as e:
         mylogger.exception(f"An unexpected error occurred: {e}")
-    finally:
-        if engine:
-            engine.dispose()
-            mylogger.debug("SQLAlchemy engine connections disposed.")
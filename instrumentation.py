@@ -0,0 +1,179 @@
+# instrumentation.py
+# Per-collector timing, memory and call counters for the impact metrics run
+import contextvars
+import resource
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from typing import Iterator, List, Optional
+
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.types import Date, Float, Integer, String
+
+# Column types of the timings table, next to impact_model_metrics
+TIMINGS_DTYPES = {
+    "run_ts": Date(),
+    "collector": String(64),
+    "status": String(16),
+    "wall_time": Float(),
+    "cpu_time": Float(),
+    "peak_rss_delta_kb": Integer(),
+    "http_requests": Integer(),
+    "http_bytes": Integer(),
+    "db_queries": Integer(),
+    "db_rows": Integer(),
+}
+
+
+@dataclass
+class CollectorStats:
+    collector: str
+    status: str = "ok"
+    wall_time: float = 0.0
+    cpu_time: float = 0.0  # process-wide (incl. subprocesses), so it overlaps in concurrent mode
+    peak_rss_delta_kb: int = 0  # growth of the process' peak RSS while the collector ran
+    http_requests: int = 0
+    http_bytes: int = 0
+    db_queries: int = 0
+    db_rows: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, counter: str, value: int) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def as_record(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.name != "_lock"}
+
+
+_current: contextvars.ContextVar[Optional[CollectorStats]] = contextvars.ContextVar("collector_stats", default=None)
+_active: List[CollectorStats] = []
+_finished: List[CollectorStats] = []
+_state_lock = threading.Lock()
+_hooks_installed = False
+
+
+def _stats_for_call() -> Optional[CollectorStats]:
+    """
+    The collector a call belongs to. Threads started by a collector don't inherit its context,
+    so when only one collector is running, calls without a context are attributed to it.
+    """
+    stats = _current.get()
+    if stats is None:
+        with _state_lock:
+            if len(_active) == 1:
+                stats = _active[0]
+    return stats
+
+
+def _count_http(num_bytes: int) -> None:
+    stats = _stats_for_call()
+    if stats is not None:
+        stats.add("http_requests", 1)
+        stats.add("http_bytes", num_bytes)
+
+
+def _count_db(num_rows: int) -> None:
+    stats = _stats_for_call()
+    if stats is not None:
+        stats.add("db_queries", 1)
+        stats.add("db_rows", max(num_rows, 0))
+
+
+def install_hooks() -> None:
+    """Hook into requests, urllib, httplib2 (googleapiclient) and SQLAlchemy to count calls. Idempotent."""
+    global _hooks_installed
+    with _state_lock:
+        if _hooks_installed:
+            return
+        _hooks_installed = True
+
+    import requests
+
+    original_send = requests.Session.send
+
+    def send(self, request, **kwargs):
+        response = original_send(self, request, **kwargs)
+        # Don't force streamed bodies into memory just to count them
+        num_bytes = int(response.headers.get("Content-Length", 0)) if kwargs.get("stream") else len(response.content)
+        _count_http(num_bytes)
+        return response
+
+    requests.Session.send = send
+
+    original_open = urllib.request.OpenerDirector.open
+
+    def urllib_open(self, *args, **kwargs):
+        response = original_open(self, *args, **kwargs)
+        _count_http(int(response.headers.get("Content-Length") or 0))
+        return response
+
+    urllib.request.OpenerDirector.open = urllib_open
+
+    try:
+        import httplib2
+    except ImportError:
+        httplib2 = None
+    if httplib2 is not None:
+        original_request = httplib2.Http.request
+
+        def httplib2_request(self, *args, **kwargs):
+            response, content = original_request(self, *args, **kwargs)
+            _count_http(len(content or b""))
+            return response, content
+
+        httplib2.Http.request = httplib2_request
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _count_db(cursor.rowcount)
+
+
+def _cpu_time() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextmanager
+def measure(collector: str) -> Iterator[CollectorStats]:
+    """Record wall time, CPU time, peak RSS growth and HTTP/DB calls of everything run inside this block."""
+    install_hooks()
+    stats = CollectorStats(collector=collector)
+    token = _current.set(stats)
+    with _state_lock:
+        _active.append(stats)
+
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_time()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        yield stats
+    except BaseException:
+        stats.status = "error"
+        raise
+    finally:
+        stats.wall_time = time.perf_counter() - start_wall
+        stats.cpu_time = _cpu_time() - start_cpu
+        stats.peak_rss_delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        _current.reset(token)
+        with _state_lock:
+            _active.remove(stats)
+            _finished.append(stats)
+
+
+def reset() -> None:
+    """Forget the stats of earlier collectors, at the start of a run."""
+    with _state_lock:
+        _finished.clear()
+
+
+def collected_stats() -> pd.DataFrame:
+    """The stats of all collectors measured since the last reset(), one row per collector."""
+    with _state_lock:
+        records = [stats.as_record() for stats in _finished]
+    return pd.DataFrame(records, columns=[c for c in TIMINGS_DTYPES if c != "run_ts"])
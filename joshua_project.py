@@ -1,46 +1,65 @@
-import urllib.request
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from silapiimporter import SILAPIImporter
 from dotenv import load_dotenv
-from sqlalchemy import text
 
 
 class JoshuaProjectImport(SILAPIImporter):
+    # Default number of pages fetched in parallel
+    CONCURRENCY = 4
+    # The only fields of a people group we need: the ones we store, plus ROG3 for the country lookup
+    API_COLUMNS = [
+        "PeopleID3ROG3", "PeopleID3", "PeopNameInCountry", "ROG3", "LeastReached",
+        "PrimaryLanguageName", "ROL3", "Population", "JPScale", "BibleStatus", "Frontier"
+    ]
+
     def __init__(self):
         super().__init__()
         self.__logger = self._init_logger()
         load_dotenv()
 
-    def pull_from_api(self):
+    def pull_from_api(self, concurrency=None):
         # set some important variables
         domain = os.getenv('JP_BASE_URL')
         api_key = os.getenv('JP_KEY')
+        concurrency = concurrency or int(os.getenv('JP_CONCURRENCY', self.CONCURRENCY))
 
         limit = 2000
-        records = 2000
-        page = 1
-        jp_full_data = None
-
-        while records == limit:
-            url = domain + "/v1/people_groups.json?api_key=" + api_key + "&limit=" + str(limit) + "&page=" + str(page)
-            conn = urllib.request.urlopen(url).read()
-            jp_json = json.loads(conn)
-            records = len(jp_json)
-            page += 1
-            if jp_full_data is not None:
-                jp_full_data += jp_json
-            else:
-                jp_full_data = jp_json
-
-        for i in range(len(jp_full_data)):
-            jp_full_data[i].pop("Resources")
-
-        df = pd.DataFrame(jp_full_data)
+        pages = []
+        next_page = 1
+        last_page_found = False
+
+        # Fetch pages in waves of `concurrency` requests, until a short or empty page shows up
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not last_page_found:
+                wave = range(next_page, next_page + concurrency)
+                futures = [executor.submit(self._fetch_page, domain, api_key, limit, page) for page in wave]
+                next_page += concurrency
+
+                # Keep the page order, and ignore anything after the last page
+                for future in futures:
+                    jp_json = future.result()
+                    pages.append(jp_json)
+                    if len(jp_json) < limit:
+                        last_page_found = True
+                        break
+
+        jp_full_data = [record for page_data in pages for record in page_data]
+        self.__logger.debug(f"Fetched {len(jp_full_data)} people groups in {len(pages)} pages.")
+
+        df = pd.DataFrame.from_records(jp_full_data, columns=self.API_COLUMNS)
 
         return df
 
+    def _fetch_page(self, domain, api_key, limit, page):
+        url = domain + "/v1/people_groups.json?api_key=" + api_key + "&limit=" + str(limit) + "&page=" + str(page)
+
+        # The API has no field selection, so drop everything we don't store right away, page by page
+        return [tuple(record.get(col) for col in self.API_COLUMNS)
+                for record in json.loads(self._urlopen_with_retry(url))]
+
     def import_data(self):
         # Pull data from API
         df = self.pull_from_api()
@@ -54,15 +73,12 @@ class JoshuaProjectImport(SILAPIImporter):
             raise Exception(
                 f"Duplicate found! The first duplicate row has a 'the_count' value greater than 1: {duplicates.iloc[0]}")
 
-        # Setup DB conn
-        engine = self._get_db_connection()
-
-        # Cross-reference with what's already in DB
-        cross_ref = pd.read_sql(sql='jp_cross_ref_cntry_codes', con=engine)
-        uw_country = pd.read_sql(sql='countries', con=engine)
-
-        full_country_ref = pd.merge(cross_ref, uw_country, left_on='ISO2', right_on='alpha_2_code')
-        jp_data = df.merge(full_country_ref, on='ROG3', how='left')
+        # Cross-reference with what's already in DB, through the cached ROG3 -> country lookup
+        country_lookup = self._get_country_lookup()
+        jp_data = df.assign(
+            english_short_name=df['ROG3'].map(country_lookup['english_short_name']),
+            ISO2=df['ROG3'].map(country_lookup['ISO2'])
+        )
         slim_jp = jp_data[[
             "PeopleID3ROG3", "PeopleID3", "PeopNameInCountry", "english_short_name", "ISO2", "LeastReached",
             "PrimaryLanguageName", "ROL3", "Population", "JPScale", "BibleStatus", "Frontier"
@@ -73,70 +89,15 @@ class JoshuaProjectImport(SILAPIImporter):
         slim_jp.columns = map(str.lower, slim_jp.columns)
 
         try:
-            # Insert or update data using explicit INSERT and UPDATE
             table = 'joshua_project_data'
             database = os.getenv('TDB_DB')  # Reintroduce database for logging
 
-            # Iterate through the DataFrame and explicitly insert or update the rows
-            with engine.connect() as conn:
-                num_inserts = 0
-                num_updates = 0
-                for index, row in slim_jp.iterrows():
-                    columns = list(slim_jp.columns)
-                    primary_key_col = 'peopleid3rog3'  # Assuming this is your primary key
-
-                    # Fetch existing row
-                    select_query = text(f"""
-                        SELECT {', '.join(columns)}
-                        FROM `uw-data-tracking`.{table}
-                        WHERE {primary_key_col} = :pk
-                    """)
-                    existing_row = conn.execute(select_query, {"pk": row[primary_key_col]}).fetchone()
-
-                    # Build dict of non-NaN values for current row
-                    current_row_dict = {col: (val if pd.notna(val) else None) for col, val in row.items()}
-
-                    # If no existing row, we insert
-                    if existing_row is None:
-                        num_inserts += 1
-                        col_str = ', '.join(columns)
-                        placeholders = ', '.join([f":{col}" for col in columns])
-
-                        insert_query = text(f"""
-                            INSERT INTO `uw-data-tracking`.{table} ({col_str})
-                            VALUES ({placeholders});
-                        """)
-                        conn.execute(insert_query, current_row_dict)
-                    else:
-                        # If existing row is found, we check if there's any difference and update
-                        update_needed = False
-                        existing_row_dict = dict(existing_row._mapping)
-                        for col in columns:
-                            if existing_row_dict.get(col) != current_row_dict.get(col):
-                                self.__logger.info(f"Column {col} of row with key {existing_row_dict['peopleid3rog3']}"
-                                                   f" has changed. previous value: {existing_row_dict.get(col)} "
-                                                   f"current value: {current_row_dict.get(col)}")
-                                update_needed = True
-                                num_updates += 1
-                                break  # As soon as one difference is found, we update
-
-                        if update_needed:
-                            # Create the UPDATE query
-                            set_values = ', '.join([f"{col} = :{col}" for col in columns if col != primary_key_col])
-                            update_query = text(f"""
-                                UPDATE `uw-data-tracking`.{table}
-                                SET {set_values}
-                                WHERE {primary_key_col} = :peopleid3rog3
-                            """)
-                            # Explicitly ensure the primary key is included for update
-                            current_row_dict[primary_key_col] = row[
-                                primary_key_col]  # Include pk in the dictionary for the UPDATE
-                            conn.execute(update_query, current_row_dict)
-                conn.commit()
-                self.__logger.info("commit complete.")
+            result = self._sync_table(slim_jp, table, primary_key_col='peopleid3rog3', use_hash=True)
+            self.__logger.info("commit complete.")
 
             self.__logger.info(
-                f"Inserted {num_inserts} rows and updated {num_updates} rows successfully into '{database}.{table}'!")
+                f"Inserted {result['inserted']} rows and updated {result['updated']} rows successfully into "
+                f"'{database}.{table}'! ({result['unchanged']} rows unchanged)")
 
         except Exception as ex:
             self.__logger.error(f"Error during insert/update: {ex}")
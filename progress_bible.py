@@ -1,20 +1,28 @@
+import codecs
 import os
+import re
+import tempfile
+import urllib.error
 import urllib.request
 import json
+from hashlib import sha256
 import pandas as pd
 from dotenv import load_dotenv
 from silapiimporter import *
-from sqlalchemy import text
 import ssl
 
 
 class ProgressBibleImport(SILAPIImporter):
+    FETCH_CACHE_NAME = 'progress_bible_allaccess'
+    # Number of bytes read from the feed at a time
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self):
         super().__init__()
         self.__logger = self._init_logger()
         load_dotenv()
 
-    def import_data(self):
+    def import_data(self, force=False):
         key = os.getenv('PB_KEY')
         base_url = os.getenv('PB_AAG_URL')
         url = f"{base_url}?file=AllAccess.json"
@@ -22,6 +30,13 @@ class ProgressBibleImport(SILAPIImporter):
         req = urllib.request.Request(url)
         req.add_header("X-DreamFactory-API-Key", key)
 
+        # Ask the server to only send the feed when it changed since our last import
+        fetch_cache = {} if force else self._load_fetch_cache(self.FETCH_CACHE_NAME)
+        if fetch_cache.get('etag'):
+            req.add_header("If-None-Match", fetch_cache['etag'])
+        if fetch_cache.get('last_modified'):
+            req.add_header("If-Modified-Since", fetch_cache['last_modified'])
+
         # There are problems with the presented certificate.
         # `SSL certificate problem: unable to get local issuer certificate`
         # We have tried several methods, but could not get it to work
@@ -31,77 +46,151 @@ class ProgressBibleImport(SILAPIImporter):
         context.check_hostname = False
         context.verify_mode = ssl.CERT_NONE
 
-        obj_json = json.loads(urllib.request.urlopen(req, context=context).read())
+        try:
+            response = urllib.request.urlopen(req, context=context)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304:
+                self.__logger.info("AllAccess.json has not changed since the last import, nothing to do.")
+                return
+            raise
+
+        # Stream the body to a temporary file, so it never has to fit in memory as a whole.
+        # Closing the response releases the socket, also when we return early.
+        with response, tempfile.TemporaryFile() as body_file:
+            body_hash = sha256()
+            for chunk in iter(lambda: response.read(self.CHUNK_SIZE), b''):
+                body_hash.update(chunk)
+                body_file.write(chunk)
+
+            # Not every server honors conditional requests, so compare the content as well
+            digest = body_hash.hexdigest()
+            new_fetch_cache = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'digest': digest
+            }
+            if digest == fetch_cache.get('digest'):
+                self.__logger.info("AllAccess.json content is identical to the last import, nothing to do.")
+                self._save_fetch_cache(self.FETCH_CACHE_NAME, new_fetch_cache)
+                return
+
+            body_file.seek(0)
+            pb_dataframe = self._records_to_dataframe(self._iter_json_array(body_file, 'resource'))
 
-        pb_dataframe = pd.DataFrame.from_dict(obj_json['resource'])
         pb_dataframe['IsProtectedCountry'] = pb_dataframe['IsProtectedCountry'].astype(int)
         pb_dataframe.columns = map(str.lower, pb_dataframe.columns)
 
         try:
-            # Setup connection to DB
             database = os.getenv('TDB_DB')
 
-            engine = self._get_db_connection()
-
-            # Insert or update data using upsert
+            # Insert or update data using the shared table sync
             table = 'pb_language_data'
+            result = self._sync_table(pb_dataframe, table, primary_key_col='languagecode', use_hash=True)
+            self.__logger.info("commit complete.")
+
+            self.__logger.info(f"Inserted {result['inserted']} rows and updated {result['updated']} rows successfully "
+                               f"into '{database}.{table}'!")
 
-            with engine.connect() as conn:
-                num_inserts = 0
-                num_updates = 0
-                for index, row in pb_dataframe.iterrows():
-                    # Extract columns and build param placeholders
-                    columns = list(pb_dataframe.columns)
-                    primary_key_col = 'languagecode'
-
-                    # Fetch existing row
-                    select_query = text(f"""
-                        SELECT {', '.join(columns)}
-                        FROM `uw-data-tracking`.{table}
-                        WHERE {primary_key_col} = :pk
-                    """)
-                    existing_row = conn.execute(select_query, {"pk": row[primary_key_col]}).fetchone()
-
-                    # Build dict of non-NaN values for current row
-                    current_row_dict = {col: (val if pd.notna(val) else None) for col, val in row.items()}
-
-                    update_needed = False
-                    if existing_row is None:
-                        update_needed = True  # No existing row, need to insert
-                        num_inserts = num_inserts + 1
-                    else:
-                        existing_row_dict = dict(existing_row._mapping)
-                        for col in columns:
-                            if existing_row_dict.get(col) != current_row_dict.get(col):
-                                self.__logger.info(f"Column {col} of row with key {existing_row_dict['languagecode']}"
-                                                   f" has changed. previous value: {existing_row_dict.get(col)} "
-                                                   f"current value: {current_row_dict.get(col)}")
-                                update_needed = True
-                                num_updates = num_updates + 1
-                                break
-
-                    if update_needed:
-                        col_str = ', '.join(columns)
-                        placeholders = ', '.join([f":{col}" for col in columns])
-                        update_values = ', '.join([f"{col} = VALUES({col})" for col in columns])
-
-                        query = text(f"""
-                            INSERT INTO `uw-data-tracking`.{table} ({col_str})
-                            VALUES ({placeholders})
-                            ON DUPLICATE KEY UPDATE {update_values};
-                        """)
-
-                        with engine.begin():
-                            conn.execute(query, current_row_dict)
-                conn.commit()
-                self.__logger.info("commit complete.")
-
-            self.__logger.info(f"Inserted {num_inserts} rows and updated {num_updates} rows successfully into '{database}.{table}'!")
+            # Only remember this version of the feed once it is safely in the DB
+            self._save_fetch_cache(self.FETCH_CACHE_NAME, new_fetch_cache)
 
         except Exception as ex:
             self.__logger.error(f"Connection could not be made due to the following error: \n{ex}")
 
 
+    def _iter_json_array(self, stream, key):
+        """
+        Incrementally parses the array under `key` of a JSON object from a binary stream
+        and yields its items one by one, so only a single chunk of the raw JSON is held in memory.
+        """
+        json_decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def read_more():
+            nonlocal buffer, pos, eof
+            chunk = stream.read(self.CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+            pos = 0
+
+        # Find the start of the array
+        array_start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        while True:
+            match = array_start.search(buffer, pos)
+            if match:
+                pos = match.end()
+                break
+            if eof:
+                raise ValueError(f"No '{key}' array found in JSON stream")
+            # Keep a tail, in case the key is split over two chunks
+            pos = max(0, len(buffer) - len(key) - 16)
+            read_more()
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError(f"Unterminated '{key}' array in JSON stream")
+                read_more()
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = json_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Item is incomplete, get the rest of it first
+                read_more()
+                continue
+            yield item
+
+    def _records_to_dataframe(self, records):
+        """
+        Builds a DataFrame from an iterable of dicts, filling column buffers batch by batch.
+        Every full batch is converted to typed arrays right away, and each final column is
+        concatenated from its arrays (releasing them) one column at a time, so the arrays and
+        the finished frame are never both held in full.
+        """
+        column_chunks = {}
+        column_buffers = {}
+        num_rows = 0
+        total_rows = 0
+
+        for record in records:
+            for col in record:
+                if col not in column_buffers:
+                    column_buffers[col] = [None] * num_rows
+            for col, values in column_buffers.items():
+                values.append(record.get(col))
+            num_rows += 1
+
+            if num_rows == self.BATCH_SIZE:
+                for col, values in column_buffers.items():
+                    column_chunks.setdefault(col, []).append(
+                        pd.Series(values, index=pd.RangeIndex(total_rows, total_rows + num_rows)))
+                total_rows += num_rows
+                column_buffers = {}
+                num_rows = 0
+
+        for col, values in column_buffers.items():
+            column_chunks.setdefault(col, []).append(
+                pd.Series(values, index=pd.RangeIndex(total_rows, total_rows + num_rows)))
+        total_rows += num_rows
+
+        columns = {}
+        for col in list(column_chunks):
+            column = pd.concat(column_chunks.pop(col))
+            if len(column) < total_rows:
+                # The column is missing from some batches
+                column = column.reindex(pd.RangeIndex(total_rows))
+            columns[col] = column
+        return pd.DataFrame(columns, index=pd.RangeIndex(total_rows), copy=False)
+
 if __name__ == '__main__':
     obj_pb_importer = ProgressBibleImport()
     obj_pb_importer.import_data()
@@ -1,12 +1,28 @@
 import hmac
+import json
+import pickle
+import urllib.error
+import urllib.request
 from hashlib import sha1
-from time import time
-from sqlalchemy import create_engine
+from time import sleep, time
+from sqlalchemy import bindparam, text
+import numpy as np
+import pandas as pd
 import os
 import logging
+from functions import get_cache_dir, get_engine
 
 
 class SILAPIImporter:
+    # Default number of rows sent to the DB per executemany batch
+    BATCH_SIZE = 1000
+    # Side table holding the content hash of every synced row
+    HASH_TABLE = 'sync_row_hashes'
+    # Retries (with exponential backoff) for transient HTTP errors
+    HTTP_RETRIES = 4
+    HTTP_BACKOFF_SECONDS = 1
+    RETRYABLE_HTTP_CODES = (429, 500, 502, 503, 504)
+
     def __init__(self):
         self.__logger = logging.getLogger()
 
@@ -31,19 +47,9 @@ class SILAPIImporter:
         return this_logger
 
     def _get_db_connection(self):
-        port = 3306
-        user = os.getenv('TDB_USER')
-        password = os.getenv('TDB_PASSWORD')
-        host = os.getenv('TDB_HOST')
-        database = os.getenv('TDB_DB')
         engine = None
         try:
-            engine = create_engine(
-                url="mysql+pymysql://{0}:{1}@{2}:{3}/{4}".format(
-                    user, password, host, port, database
-                )
-            )
-            self.__logger.debug(f"Connection to host '{host}' for user '{user}' created successfully.")
+            engine = get_engine()
 
         except Exception as ex:
 
@@ -51,6 +57,114 @@ class SILAPIImporter:
 
         return engine
 
+    def _urlopen_with_retry(self, url, **kwargs):
+        """
+        Returns the body of `url`, retrying transient HTTP and network errors with exponential backoff.
+        """
+        attempt = 0
+        while True:
+            try:
+                with urllib.request.urlopen(url, **kwargs) as response:
+                    return response.read()
+            except urllib.error.HTTPError as ex:
+                if ex.code not in self.RETRYABLE_HTTP_CODES or attempt >= self.HTTP_RETRIES:
+                    raise
+                error = ex
+            except (urllib.error.URLError, TimeoutError, ConnectionError) as ex:
+                if attempt >= self.HTTP_RETRIES:
+                    raise
+                error = ex
+
+            delay = self.HTTP_BACKOFF_SECONDS * 2 ** attempt
+            attempt += 1
+            self.__logger.warning(f"Request failed ({error}), retry {attempt} of {self.HTTP_RETRIES} in {delay}s")
+            sleep(delay)
+
+    def _load_fetch_cache(self, name):
+        # Returns the stored metadata (ETag, Last-Modified, digest) of the last successful fetch
+        cache_file = os.path.join(get_cache_dir('fetch'), f"{name}.json")
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as ex:
+            self.__logger.warning(f"Ignoring unreadable fetch cache '{cache_file}': {ex}")
+            return {}
+
+    def _save_fetch_cache(self, name, metadata):
+        cache_file = os.path.join(get_cache_dir('fetch'), f"{name}.json")
+        with open(cache_file, 'w') as f:
+            json.dump(metadata, f)
+
+    def _read_reference_table(self, table, fingerprint=None):
+        """
+        Returns a small, rarely changing table as a DataFrame, from a local cache when possible.
+        The cache is invalidated when the row count or the CHECKSUM TABLE value of the table changes.
+        Pass `fingerprint` when the caller already computed it, to save the table scan.
+        """
+        cache_file = os.path.join(get_cache_dir('reference'), f"{table}.pkl")
+
+        engine = self._get_db_connection()
+        with engine.connect() as conn:
+            if fingerprint is None:
+                fingerprint = self._table_fingerprint(conn, table)
+
+            cached = self._load_pickle(cache_file)
+            if cached is not None and cached['fingerprint'] == fingerprint:
+                self.__logger.debug(f"Using cached copy of reference table '{table}'.")
+                return cached['data']
+
+            data = pd.read_sql_table(table, con=conn)
+
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'fingerprint': fingerprint, 'data': data}, f)
+        self.__logger.debug(f"Refreshed cached copy of reference table '{table}'.")
+
+        return data
+
+    def _get_country_lookup(self):
+        """
+        Returns the ROG3 -> (english_short_name, ISO2) lookup, as a DataFrame indexed on ROG3.
+        Built from jp_cross_ref_cntry_codes and countries, and cached as long as both are unchanged.
+        """
+        cache_file = os.path.join(get_cache_dir('reference'), 'country_lookup.pkl')
+
+        engine = self._get_db_connection()
+        with engine.connect() as conn:
+            fingerprint = [self._table_fingerprint(conn, table) for table in ('jp_cross_ref_cntry_codes', 'countries')]
+
+        cached = self._load_pickle(cache_file)
+        if cached is not None and cached['fingerprint'] == fingerprint:
+            return cached['data']
+
+        cross_ref = self._read_reference_table('jp_cross_ref_cntry_codes', fingerprint[0])
+        uw_country = self._read_reference_table('countries', fingerprint[1])
+        full_country_ref = pd.merge(cross_ref, uw_country, left_on='ISO2', right_on='alpha_2_code')
+        lookup = (full_country_ref[['ROG3', 'english_short_name', 'ISO2']]
+                  .drop_duplicates(subset='ROG3')
+                  .set_index('ROG3'))
+
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'fingerprint': fingerprint, 'data': lookup}, f)
+
+        return lookup
+
+    def _table_fingerprint(self, conn, table):
+        num_rows = conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+        checksum = conn.execute(text(f"CHECKSUM TABLE {table}")).fetchone()[1]
+        return [num_rows, checksum]
+
+    def _load_pickle(self, cache_file):
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as ex:
+            self.__logger.warning(f"Ignoring unreadable cache file '{cache_file}': {ex}")
+            return None
+
     def _create_signature(self, key, secret):
         curr_time = str(int(time()))
 
@@ -67,3 +181,171 @@ class SILAPIImporter:
 
         return api_sig
 
+    def _sync_table(self, df, table, primary_key_col, columns=None, batch_size=None,
+                    schema='uw-data-tracking', delete_missing=False, use_hash=False):
+        """
+        Synchronizes the rows of a DataFrame into a table.
+        The table is read once, diffed in memory against the DataFrame and only new and changed
+        rows are written, as one upsert in batches of `batch_size`. Rows that exist in the table
+        but not in the DataFrame are counted as deleted, and only removed when `delete_missing` is set.
+        With `use_hash`, a content hash per row is kept in a side table and only rows whose hash
+        differs from the stored one are read back and compared column by column.
+        Returns a dict with the number of inserted, updated, unchanged and deleted rows.
+        """
+        if columns is None:
+            columns = list(df.columns)
+        elif primary_key_col not in columns:
+            columns = [primary_key_col] + list(columns)
+        batch_size = batch_size or self.BATCH_SIZE
+        df = df[columns]
+        full_table = f"`{schema}`.{table}"
+
+        engine = self._get_db_connection()
+        with engine.connect() as conn:
+            if use_hash:
+                hash_table = f"`{schema}`.{self.HASH_TABLE}"
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {hash_table} (
+                        table_name VARCHAR(64) NOT NULL,
+                        row_key VARCHAR(255) NOT NULL,
+                        row_hash CHAR(16) NOT NULL,
+                        PRIMARY KEY (table_name, row_key)
+                    )
+                """))
+                row_hashes = self._hash_rows(df)
+                stored_hashes = pd.read_sql(
+                    text(f"SELECT row_key, row_hash FROM {hash_table} WHERE table_name = :table_name"),
+                    con=conn, params={'table_name': table}
+                ).set_index('row_key')['row_hash']
+                existing_keys = pd.read_sql(text(f"SELECT {primary_key_col} FROM {full_table}"),
+                                            con=conn)[primary_key_col]
+
+                # Rows with an unchanged hash are skipped, all others get the full column compare
+                hash_matches = ((df[primary_key_col].astype(str).map(stored_hashes) == row_hashes)
+                                & df[primary_key_col].isin(existing_keys)).to_numpy()
+                to_compare = df[~hash_matches]
+                existing = self._read_rows(conn, full_table, columns, primary_key_col,
+                                           to_compare.loc[to_compare[primary_key_col].isin(existing_keys),
+                                                          primary_key_col],
+                                           batch_size)
+                new_rows, changed_rows, unchanged_rows = self._diff_frames(to_compare, existing, primary_key_col)
+                num_unchanged = int(hash_matches.sum()) + len(unchanged_rows)
+            else:
+                existing = pd.read_sql(text(f"SELECT {', '.join(columns)} FROM {full_table}"), con=conn)
+                existing_keys = existing[primary_key_col]
+                new_rows, changed_rows, unchanged_rows = self._diff_frames(df, existing, primary_key_col)
+                num_unchanged = len(unchanged_rows)
+            missing_keys = existing_keys[~existing_keys.isin(df[primary_key_col])]
+
+            if not new_rows.empty or not changed_rows.empty:
+                # One upsert for new and changed rows: PyMySQL rewrites an executemany of
+                # INSERT ... VALUES into multi-row statements, which it doesn't do for UPDATE
+                col_str = ', '.join(columns)
+                placeholders = ', '.join([f":{col}" for col in columns])
+                update_values = ', '.join([f"{col} = VALUES({col})" for col in columns if col != primary_key_col])
+                if update_values:
+                    upsert_query = text(f"INSERT INTO {full_table} ({col_str}) VALUES ({placeholders}) "
+                                        f"ON DUPLICATE KEY UPDATE {update_values}")
+                else:
+                    # Only the key is synced, so there is nothing to update on existing rows
+                    upsert_query = text(f"INSERT IGNORE INTO {full_table} ({col_str}) VALUES ({placeholders})")
+                self._execute_batches(conn, upsert_query, pd.concat([new_rows, changed_rows]), batch_size)
+
+            if delete_missing and not missing_keys.empty:
+                delete_query = text(f"DELETE FROM {full_table} WHERE {primary_key_col} = :{primary_key_col}")
+                self._execute_batches(conn, delete_query, missing_keys.to_frame(), batch_size)
+
+            if use_hash:
+                stale_hashes = pd.DataFrame({
+                    'table_name': table,
+                    'row_key': df.loc[~hash_matches, primary_key_col].astype(str),
+                    'row_hash': row_hashes[~hash_matches],
+                })
+                replace_query = text(f"""
+                    REPLACE INTO {hash_table} (table_name, row_key, row_hash)
+                    VALUES (:table_name, :row_key, :row_hash)
+                """)
+                self._execute_batches(conn, replace_query, stale_hashes, batch_size)
+                if delete_missing and not missing_keys.empty:
+                    delete_hash_query = text(f"DELETE FROM {hash_table} "
+                                             f"WHERE table_name = :table_name AND row_key = :row_key")
+                    self._execute_batches(conn, delete_hash_query,
+                                          pd.DataFrame({'table_name': table, 'row_key': missing_keys.astype(str)}),
+                                          batch_size)
+
+            conn.commit()
+            self.__logger.debug(f"Sync of {full_table} committed.")
+
+        return {
+            'inserted': len(new_rows),
+            'updated': len(changed_rows),
+            'unchanged': num_unchanged,
+            'deleted': len(missing_keys) if delete_missing else 0,
+            'missing': len(missing_keys),
+        }
+
+    def _hash_rows(self, df):
+        """
+        Returns a stable content hash per row, as a 16 character hex string.
+        Values are normalized to their string representation, with NaN and None hashing the same.
+        """
+        normalized = df.astype(object).where(df.notna(), None).astype(str)
+        return pd.util.hash_pandas_object(normalized, index=False).map('{:016x}'.format)
+
+    def _read_rows(self, conn, full_table, columns, primary_key_col, keys, batch_size):
+        # Fetch only the rows for the given keys, one IN query per batch
+        query = text(f"""
+            SELECT {', '.join(columns)}
+            FROM {full_table}
+            WHERE {primary_key_col} IN :keys
+        """).bindparams(bindparam('keys', expanding=True))
+        keys = list(keys)
+        frames = [pd.read_sql(query, con=conn, params={'keys': keys[batch_start:batch_start + batch_size]})
+                  for batch_start in range(0, len(keys), batch_size)]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def _diff_frames(self, incoming, existing, primary_key_col):
+        """
+        Compares the incoming frame against a snapshot of the table, keyed by the primary key.
+        Returns three frames: new rows, changed rows and unchanged rows.
+        Two NaN/None values are considered equal.
+        """
+        columns = list(incoming.columns)
+        existing = existing.drop_duplicates(subset=primary_key_col).set_index(primary_key_col)
+
+        is_new = ~incoming[primary_key_col].isin(existing.index)
+        new_rows = incoming[is_new]
+        candidates = incoming[~is_new]
+
+        previous = existing.reindex(candidates[primary_key_col])
+        differs = np.zeros(len(candidates), dtype=bool)
+        first_changed_col = np.full(len(candidates), None, dtype=object)
+        for col in columns:
+            if col == primary_key_col:
+                continue
+            current_values = candidates[col].to_numpy(dtype=object)
+            previous_values = previous[col].to_numpy(dtype=object)
+            both_null = pd.isna(current_values) & pd.isna(previous_values)
+            col_differs = (current_values != previous_values) & ~both_null
+            first_changed_col[col_differs & ~differs] = col
+            differs |= col_differs
+
+        changed_rows = candidates[differs]
+        unchanged_rows = candidates[~differs]
+
+        for current_row_dict, col in zip(changed_rows.to_dict('records'), first_changed_col[differs]):
+            key = current_row_dict[primary_key_col]
+            self.__logger.info(f"Column {col} of row with key {key}"
+                               f" has changed. previous value: {existing.at[key, col]} "
+                               f"current value: {current_row_dict[col]}")
+
+        return new_rows, changed_rows, unchanged_rows
+
+    def _execute_batches(self, conn, query, frame, batch_size=None):
+        # Build dicts of non-NaN values and send them to the DB as executemany batches
+        batch_size = batch_size or self.BATCH_SIZE
+        records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+        for batch_start in range(0, len(records), batch_size):
+            conn.execute(query, records[batch_start:batch_start + batch_size])
@@ -1,9 +1,14 @@
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
-from functions import get_logger
+from functions import get_cache_dir, get_logger
 
 #########################################################################################################
 #                       Scraping the Google Folder for the Case Study and White Papers
@@ -27,8 +32,26 @@ FOLDER_ID = folder_ids_raw.split(",") if folder_ids_raw else []
 folder_name_raw = os.getenv("GOOGLE_FOLDER_NAME")
 FOLDER_NAME = folder_name_raw.split(",") if folder_name_raw else []
 
+# Number of folders counted in parallel, and retries (exponential backoff) on rate limit (403/429) and 5xx errors
+MAX_WORKERS = int(os.getenv("GOOGLE_DRIVE_MAX_WORKERS", 4))
+NUM_RETRIES = 5
+
+# Maximum number of calls in one Drive batch request, and files per listed page (the Drive maximum, default is 100)
+BATCH_SIZE = 100
+PAGE_SIZE = 1000
+
+# Incremental mode: keep the file ids of every folder locally and only apply the shared drive's changes feed
+# since the last run. A full recount is still done every FULL_RECOUNT_DAYS days, as a consistency check
+INCREMENTAL = os.getenv("GOOGLE_DRIVE_INCREMENTAL", "1") == "1"
+FULL_RECOUNT_DAYS = float(os.getenv("GOOGLE_DRIVE_FULL_RECOUNT_DAYS", 7))
+CHANGES_PAGE_SIZE = 1000
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
 mylogger = get_logger()
 
+# googleapiclient's httplib2 transport isn't thread-safe, so each worker thread gets its own Drive client
+_thread_local = threading.local()
+
 def get_drive_service_account():
     """Authenticates with Google Drive API using a service account."""
     try:
@@ -41,48 +64,53 @@ def get_drive_service_account():
         mylogger.exception(f"Error authenticating with service account: {e}")
         return None
 
-def count_items_in_shared_drive_folder(service, shared_drive_id, folder_id, folder_name):
+def _list_folder_items(service, shared_drive_id, folder_id, page_token=None):
+    """Builds the request for one page of the documents/objects directly within a folder."""
+    # Construct the query to list files in the specified folder, excluding trashed items and folders themselves
+    # 'trashed = false' ensures we only count active files
+    # 'mimeType != "application/vnd.google-apps.folder"' excludes subfolders from the count
+    query = (
+        f"'{folder_id}' in parents and trashed = false "
+        "and mimeType != 'application/vnd.google-apps.folder'"
+    )
+
+    return service.files().list(
+        q=query,
+        corpora='drive',                  # Important for Shared Drives
+        driveId=shared_drive_id,          # ID of the Shared Drive
+        includeItemsFromAllDrives=True,   # Required for Shared Drives
+        supportsAllDrives=True,           # Required for Shared Drives
+        fields="nextPageToken, files(id)", # Requesting only 'id' for efficient counting
+        pageSize=PAGE_SIZE,               # Folders up to PAGE_SIZE items fit in one page
+        pageToken=page_token
+    )
+
+def list_items_in_shared_drive_folder(service, shared_drive_id, folder_id, folder_name, page_token=None, file_ids=None):
     """
-    Counts the number of documents/objects directly within a specific folder
+    Lists the ids of the documents/objects directly within a specific folder
     on a Google Shared Drive. Excludes subfolders and trashed items.
+    Pass page_token and file_ids to carry on from a page that was already listed.
     """
     if not service:
         mylogger.critical("Drive service not available. Cannot count items.")
         return None
 
-    item_count = 0
-    page_token = None
+    file_ids = list(file_ids or [])
 
     try:
         #print(f"Counting items in folder '{folder_name}' within Shared Drive '{shared_drive_id}'...")
         while True:
-            # Construct the query to list files in the specified folder, excluding trashed items and folders themselves
-            # 'trashed = false' ensures we only count active files
-            # 'mimeType != "application/vnd.google-apps.folder"' excludes subfolders from the count
-            query = (
-                f"'{folder_id}' in parents and trashed = false "
-                "and mimeType != 'application/vnd.google-apps.folder'"
-            )
-
-            results = service.files().list(
-                q=query,
-                corpora='drive',                  # Important for Shared Drives
-                driveId=shared_drive_id,          # ID of the Shared Drive
-                includeItemsFromAllDrives=True,   # Required for Shared Drives
-                supportsAllDrives=True,           # Required for Shared Drives
-                fields="nextPageToken, files(id)", # Requesting only 'id' for efficient counting
-                pageToken=page_token
-            ).execute()
-
-            files = results.get('files', [])
-            item_count += len(files)
+            results = _list_folder_items(service, shared_drive_id, folder_id, page_token).execute(
+                num_retries=NUM_RETRIES)  # retries with exponential backoff
+
+            file_ids.extend(f['id'] for f in results.get('files', []))
 
             page_token = results.get('nextPageToken', None)
             if not page_token:
                 break # No more pages
 
-        #print(f"\nTotal documents/objects found in folder {folder_name}: {item_count}")
-        return item_count
+        #print(f"\nTotal documents/objects found in folder {folder_name}: {len(file_ids)}")
+        return file_ids
 
     except HttpError as error:
         mylogger.exception(f'An HTTP error occurred: {error}')
@@ -94,6 +122,222 @@ def count_items_in_shared_drive_folder(service, shared_drive_id, folder_id, fold
         mylogger.exception(f"An unexpected error occurred: {e}")
         return None
 
+def count_items_in_shared_drive_folder(service, shared_drive_id, folder_id, folder_name):
+    """
+    Counts the number of documents/objects directly within a specific folder
+    on a Google Shared Drive. Excludes subfolders and trashed items.
+    """
+    file_ids = list_items_in_shared_drive_folder(service, shared_drive_id, folder_id, folder_name)
+    return None if file_ids is None else len(file_ids)
+
+def list_first_pages(service, shared_drive_id, folder_ids):
+    """
+    Lists the first page of several folders with one batch request per BATCH_SIZE folders.
+    Returns {folder_id: response}, leaving out folders whose call failed.
+    """
+    first_pages = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            mylogger.warning(f"Batched listing of folder {folder_ids[int(request_id)]} failed: {exception}")
+        else:
+            first_pages[folder_ids[int(request_id)]] = response
+
+    for start in range(0, len(folder_ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for index in range(start, min(start + BATCH_SIZE, len(folder_ids))):
+            batch.add(_list_folder_items(service, shared_drive_id, folder_ids[index]), request_id=str(index))
+        try:
+            batch.execute()
+        except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+            # The batch request itself failed (HTTP or transport error, e.g. a timeout),
+            # its folders are counted one by one instead
+            mylogger.warning(f"Batched folder listing failed: {error}")
+
+    return first_pages
+
+def _get_thread_drive_service():
+    if getattr(_thread_local, "service", None) is None:
+        _thread_local.service = get_drive_service_account()
+    return _thread_local.service
+
+def _list_folder_in_thread(folder_id, folder_name, page_token=None, file_ids=None):
+    return list_items_in_shared_drive_folder(_get_thread_drive_service(), SHARED_DRIVE_ID, folder_id, folder_name,
+                                             page_token, file_ids)
+
+def list_folders(folders, max_workers=MAX_WORKERS, service=None):
+    """
+    Lists the item ids of several (folder_id, folder_name) folders. The first page of every folder
+    is listed in a single batch request; only folders with more pages (or whose batched call failed)
+    are then followed, in parallel with a Drive client per worker thread.
+    Returns {folder_id: [file ids]}, leaving out folders that couldn't be listed.
+    """
+    if not folders:
+        return {}
+
+    service = service or get_drive_service_account()
+    first_pages = list_first_pages(service, SHARED_DRIVE_ID, [folder_id for folder_id, _ in folders]) if service else {}
+
+    folder_items = {}
+    remaining = []  # (folder_id, folder_name, page_token, file_ids)
+    for folder_id, folder_name in folders:
+        results = first_pages.get(folder_id)
+        if results is None:
+            remaining.append((folder_id, folder_name, None, None))
+            continue
+        file_ids = [f['id'] for f in results.get('files', [])]
+        if results.get('nextPageToken'):
+            remaining.append((folder_id, folder_name, results['nextPageToken'], file_ids))
+        else:
+            folder_items[folder_id] = file_ids
+
+    if remaining:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(remaining)))) as executor:
+            listings = executor.map(lambda folder: _list_folder_in_thread(*folder), remaining)
+            for (folder_id, _, _, _), file_ids in zip(remaining, listings):
+                if file_ids is not None:  # Only store if the listing was successful
+                    folder_items[folder_id] = file_ids
+
+    return folder_items
+
+def count_folders(folder_ids=None, folder_names=None, max_workers=MAX_WORKERS, service=None):
+    """
+    Counts the items of several folders with a full listing, see list_folders().
+    Returns {folder_name: count}, leaving out folders that couldn't be counted.
+    """
+    folder_ids = FOLDER_ID if folder_ids is None else folder_ids
+    folder_names = FOLDER_NAME if folder_names is None else folder_names
+    folders = list(zip(folder_ids, folder_names))
+
+    folder_items = list_folders(folders, max_workers, service)
+    return {name: len(folder_items[folder_id]) for folder_id, name in folders if folder_id in folder_items}
+
+
+#########################################################################################################
+#                       Incremental counts from the shared drive's changes feed
+#########################################################################################################
+def _changes_state_file():
+    return os.path.join(get_cache_dir("drive"), f"changes_{SHARED_DRIVE_ID}.json")
+
+def _load_changes_state():
+    state_file = _changes_state_file()
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        mylogger.warning(f"Ignoring unreadable Drive changes state: {e}")
+        return None
+
+def _save_changes_state(state):
+    state_file = _changes_state_file()
+    # Write to a temp file first, so an interrupted run can't leave a truncated state behind
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+def get_start_page_token(service, shared_drive_id):
+    """The changes feed position of 'now' for the shared drive."""
+    response = service.changes().getStartPageToken(
+        driveId=shared_drive_id, supportsAllDrives=True).execute(num_retries=NUM_RETRIES)
+    return response['startPageToken']
+
+def apply_changes(service, shared_drive_id, page_token, folder_items):
+    """
+    Applies the shared drive's changes since page_token to folder_items ({folder_id: set of file ids}), in place.
+    A file that was removed, trashed or moved leaves the folders it was in, and a live non-folder
+    file is added to the tracked folders among its parents. Returns the page token to start from next time.
+    """
+    num_changes = 0
+    while True:
+        results = service.changes().list(
+            pageToken=page_token,
+            driveId=shared_drive_id,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            includeRemoved=True,
+            pageSize=CHANGES_PAGE_SIZE,
+            fields="nextPageToken, newStartPageToken, changes(changeType, fileId, removed, file(parents, trashed, mimeType))",
+        ).execute(num_retries=NUM_RETRIES)
+
+        for change in results.get('changes', []):
+            file_id = change.get('fileId')
+            if not file_id:  # e.g. a change to the shared drive itself
+                continue
+            num_changes += 1
+            for file_ids in folder_items.values():
+                file_ids.discard(file_id)
+
+            file = change.get('file') or {}
+            if change.get('removed') or not file or file.get('trashed') or file.get('mimeType') == FOLDER_MIME_TYPE:
+                continue
+            for parent in file.get('parents', []):
+                if parent in folder_items:
+                    folder_items[parent].add(file_id)
+
+        if 'newStartPageToken' in results:
+            mylogger.info(f"Applied {num_changes} Drive changes")
+            return results['newStartPageToken']
+        page_token = results['nextPageToken']
+
+def count_folders_incremental(folder_ids=None, folder_names=None, service=None, full_recount_days=FULL_RECOUNT_DAYS):
+    """
+    Counts the items of several folders from the file ids kept since the last run, updated with the
+    shared drive's changes feed. Falls back to a full listing on the first run, for new folders, when the
+    saved page token is no longer valid, and every full_recount_days days.
+    Returns {folder_name: count}, like count_folders().
+    """
+    folder_ids = FOLDER_ID if folder_ids is None else folder_ids
+    folder_names = FOLDER_NAME if folder_names is None else folder_names
+    folders = list(zip(folder_ids, folder_names))
+
+    service = service or get_drive_service_account()
+    if not service:
+        mylogger.critical("Drive service not available. Cannot count items.")
+        return {}
+
+    state = _load_changes_state()
+    folder_items = None
+    if state and all(folder_id in state['folders'] for folder_id in folder_ids):
+        folder_items = {folder_id: set(file_ids) for folder_id, file_ids in state['folders'].items()}
+        try:
+            state['start_page_token'] = apply_changes(service, SHARED_DRIVE_ID, state['start_page_token'], folder_items)
+        except HttpError as error:
+            mylogger.warning(f"Drive changes feed unavailable, doing a full recount: {error}")
+            folder_items = None
+        except Exception as e:
+            mylogger.exception(f"An unexpected error occurred: {e}")
+            folder_items = None
+
+    if folder_items is None or time.time() - state['recounted_at'] >= full_recount_days * 86400:
+        try:
+            # Taken before listing, so changes made during the listing are applied (again) next time
+            start_page_token = get_start_page_token(service, SHARED_DRIVE_ID)
+        except HttpError as error:
+            mylogger.exception(f'An HTTP error occurred: {error}')
+            start_page_token = None
+        listed = list_folders(folders, service=service)
+
+        if start_page_token and len(listed) == len(folders):
+            if folder_items is not None:
+                # Consistency check of the incremental counts against the full recount
+                for folder_id, name in folders:
+                    if len(folder_items[folder_id]) != len(listed[folder_id]):
+                        mylogger.warning(f"Folder '{name}': full recount found {len(listed[folder_id])} items, "
+                                         f"incremental count was {len(folder_items[folder_id])}")
+            folder_items = {folder_id: set(file_ids) for folder_id, file_ids in listed.items()}
+            state = {"start_page_token": start_page_token, "recounted_at": time.time()}
+        elif folder_items is None:
+            # Don't keep a state with folders missing, the next run recounts them all
+            return {name: len(listed[folder_id]) for folder_id, name in folders if folder_id in listed}
+        # else: keep the incremental counts, the recount is tried again next run
+
+    state['folders'] = {folder_id: sorted(file_ids) for folder_id, file_ids in folder_items.items()}
+    _save_changes_state(state)
+
+    return {name: len(folder_items[folder_id]) for folder_id, name in folders}
+
 
 if __name__ == '__main__':
     if not os.path.exists(SERVICE_ACCOUNT_FILE):
@@ -102,14 +346,7 @@ if __name__ == '__main__':
     else:
         drive_service = get_drive_service_account()
         if drive_service:
-            # Create an empty dictionary to store the counts
-            folder_counts = {}
-
-            for folder_id_single, folder_name_single in zip(FOLDER_ID, FOLDER_NAME):
-                count = count_items_in_shared_drive_folder(drive_service, SHARED_DRIVE_ID, folder_id_single,
-                                                           folder_name_single)
-                if count is not None:  # Only store if the counting was successful
-                    folder_counts[folder_name_single] = count
+            folder_counts = (count_folders_incremental if INCREMENTAL else count_folders)(service=drive_service)
 
             mylogger.info("\nSuccessfully pulled data from Google Drive")
             mylogger.debug("\n--- Summary of Folder Counts ---")
@@ -134,12 +371,7 @@ def collect_metrics():
     if not drive_service:
         raise RuntimeError("Drive service not available")
 
-    folder_counts = {}
-    for folder_id_single, folder_name_single in zip(FOLDER_ID, FOLDER_NAME):
-        count = count_items_in_shared_drive_folder(drive_service, SHARED_DRIVE_ID,
-                                                   folder_id_single, folder_name_single)
-        if count is not None:
-            folder_counts[folder_name_single] = count
+    folder_counts = (count_folders_incremental if INCREMENTAL else count_folders)(service=drive_service)
 
     case_study_count = folder_counts.get('Case Study')
     white_papers_count = folder_counts.get('White Papers')